@@ -0,0 +1,129 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from metrics import registry, Counter, CallbackGauge
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after: float = 1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission:
+    """
+    At most ``limit`` admitted requests, up to ``queue_size`` more wait in FIFO order for at most ``deadline``
+    seconds, anything beyond is refused right away.
+    """
+
+    def __init__(self, limit: int, queue_size: int, deadline: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @classmethod
+    def from_env(cls) -> "Admission":
+        limit = int(os.getenv("MAX_CONCURRENT_RENDERS", "0")) or (os.cpu_count() or 1) * 4
+        return cls(
+            limit=limit,
+            queue_size=int(os.getenv("ADMISSION_QUEUE", str(limit * 4))),
+            deadline=float(os.getenv("ADMISSION_DEADLINE", "1")),
+        )
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise Overloaded("queue_full", self.deadline)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.deadline)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as the wait ended
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise Overloaded("deadline", self.deadline) from None
+            raise
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # the slot passes to the waiter, ``active`` stays the same
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class RateLimiter:
+    """
+    Token bucket per client: ``rate`` requests per second with bursts of ``burst``.
+    Only the ``max_clients`` most recently seen clients are remembered.
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter | None":
+        rate = float(os.getenv("RATE_LIMIT", "0"))
+        if rate <= 0:
+            return None
+        return cls(rate, float(os.getenv("RATE_LIMIT_BURST", str(max(1.0, rate)))))
+
+    def take(self, client: str):
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[client] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        if not allowed:
+            raise Overloaded("rate_limit", (1 - tokens) / self.rate)
+
+
+def client_id(remote: str | None, headers) -> str:
+    """
+    RATE_LIMIT_HEADER names a header set by a trusted proxy, e.g. X-Forwarded-For, its first value is the client.
+    """
+    if RATE_LIMIT_HEADER and RATE_LIMIT_HEADER in headers:
+        return headers[RATE_LIMIT_HEADER].split(",")[0].strip()
+    return remote or ""
+
+
+def retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+RATE_LIMIT_HEADER = os.getenv("RATE_LIMIT_HEADER", "")
+
+admission = Admission.from_env()
+rate_limiter = RateLimiter.from_env()
+
+shed = registry.register(Counter("qr_shed_total", "QR requests refused by admission control", ("reason",)))
+registry.register(CallbackGauge(
+    "qr_admission_active", "QR requests admitted and being handled", lambda: {(): admission.active},
+))
+registry.register(CallbackGauge(
+    "qr_admission_queue_depth", "QR requests waiting for admission", lambda: {(): admission.waiting},
+))
@@ -1,16 +1,10 @@
-import io
 from io import BytesIO
-import png
-import qrcode
-import qrcode.image.svg
-import qrcode.image.styles.moduledrawers.svg
-import qrcode.image.styles.moduledrawers.base
-import qrcode.image.styles.colormasks
-import qrcode.image.base
-import qrcode.image.pure
+from encoder import encode, Matrix
+from metrics import stage, annotate
+from render import render_png, render_svg, render_ascii, MAX_BOX_SIZE, MAX_BORDER
 
 
-_GEN_ARGS = frozenset({"color", "invert", "background", "border"})
+_GEN_ARGS = frozenset({"color", "invert", "background", "border", "optimize", "box_size"})
 
 
 def get_colors(color: str, background: str, invert: bool) -> tuple[str, str]:
@@ -38,65 +32,53 @@ def hex_to_rgb(color: str) -> tuple[int, int, int]:
     return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
 
 
-def get_ascii_qr(data: str, border=None, invert=False, **kwargs) -> str:
-    qr = qrcode.QRCode(image_factory=qrcode.image.svg.SvgPathImage, border=int(border or 0))
-    qr.add_data(data)
-    s = io.StringIO()
+def flag(value) -> bool:
+    """
+    Boolean param given as a bool or as a query string value: 1, true, yes and on are true.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
 
-    # color, background = map(hex_to_rgb, get_colors(color, background, invert))
-    # s.write(f"\033[38;2;{color[0]};{color[1]};{color[2]}m")
-    # s.write(f"\033[48;2;{background[0]};{background[1]};{background[2]}m")
-    qr.print_ascii(s, invert=bool(invert))
-    s.seek(0)
-    return s.read()
 
+def get_border(border, default: int) -> int:
+    border = int(border or default)
+    if not 0 <= border <= MAX_BORDER:
+        raise ValueError(f"Border must be from 0 to {MAX_BORDER}")
+    return border
 
-def get_svg_qr(data: str, border=None, invert=False, background="#ffffff", color="#000000", **kwargs) -> str:
 
-    qr = qrcode.QRCode(
-        image_factory=qrcode.image.svg.SvgPathFillImage,
-        border=int(border or 4)
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    color, background = get_colors(color, background, invert)
-    qr.image_factory.QR_PATH_STYLE = {
-        "fill": color,
-        "fill-opacity": "1",
-        "fill-rule": "nonzero",
-        "stroke": "none",
-    }
-    qr.image_factory.background = background
-    # style = """
-    # width: 100%;
-    # height:100%;
-    # """
-    # if invert:
-    #     style += "filter: invert(100%);"
-    img = qr.make_image(
-        # attrib={"style": style},
-    )
-
-    return img.to_string(encoding="unicode")
-
-
-def get_bytes(data: str, border=None, invert=False, color="#000000", background="#ffffff", **kwargs) -> BytesIO:
-    qr = qrcode.QRCode(border=int(border or 4))
-    qr.add_data(data)
-    qr.make(fit=True)
-
-    # img = qr.make_image(fill_color=(255, 255, 255), back_color=(0, 0, 0))
-    img = qr.make_image()
-    png_img: png.Writer = img.get_image()
-
-    png_img.color_type = 3
+def get_matrix(data: str, version: int | None = None, optimize=False) -> Matrix:
+    with stage("encode"):
+        matrix = encode(data, version=version, optimize=flag(optimize))
+    annotate("version", (matrix.size - 17) // 4)
+    return matrix
 
-    color, background = get_colors(color, background, invert)
-    color, background = map(hex_to_rgb, (color, background))
-    png_img.palette = (color, background)
 
-    bytes = io.BytesIO()
-    img.save(bytes)
-    bytes.seek(0)
-    return bytes
+def get_ascii_qr(data: str, border=None, invert=False, version=None, optimize=False, matrix: Matrix | None = None,
+                 **kwargs) -> str:
+    border = get_border(border, 0)
+    matrix = matrix or get_matrix(data, version, optimize)
+    with stage("render"):
+        return render_ascii(matrix, border, bool(invert))
 
+
+def get_svg_qr(data: str, border=None, invert=False, background="#ffffff", color="#000000", version=None,
+               optimize=False, matrix: Matrix | None = None, **kwargs) -> str:
+    border = get_border(border, 4)
+    color, background = get_colors(color, background, invert)
+    matrix = matrix or get_matrix(data, version, optimize)
+    with stage("render"):
+        return render_svg(matrix, border, color, background)
+
+
+def get_bytes(data: str, border=None, invert=False, color="#000000", background="#ffffff", version=None,
+              optimize=False, box_size=None, matrix: Matrix | None = None, **kwargs) -> BytesIO:
+    box_size = int(box_size or 10)
+    if not 0 < box_size <= MAX_BOX_SIZE:
+        raise ValueError(f"Box size must be from 1 to {MAX_BOX_SIZE}")
+    border = get_border(border, 4)
+    color, background = map(hex_to_rgb, get_colors(color, background, invert))
+    matrix = matrix or get_matrix(data, version, optimize)
+    with stage("render"):
+        return BytesIO(render_png(matrix, border, color, background, box_size))
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import zipfile
+from typing import AsyncIterator, Iterable
+from base import _GEN_ARGS, flag
+from cache import render_cached
+from pool import RenderQueueFull
+
+CONTENT_TYPES = {"png": "image/png", "img": "image/png", "svg": "image/svg+xml", "ascii": "text/plain"}
+EXTENSIONS = {"image/png": "png", "image/svg+xml": "svg", "text/plain": "txt"}
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "0")) or (os.cpu_count() or 1) * 2
+
+
+class ZipStream:
+    """
+    Write-only file object for ``zipfile.ZipFile``, the written bytes are taken out with ``drain``.
+
+    It isn't seekable, so zipfile streams every entry with a data descriptor.
+    """
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def iter_ndjson(stream: asyncio.StreamReader) -> AsyncIterator[dict]:
+    while line := await stream.readline():
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # passed on as is, so the broken line gets its own error entry
+                yield line.decode(errors="replace")
+
+
+async def iter_items(items: Iterable[dict]) -> AsyncIterator[dict]:
+    for item in items:
+        yield item
+
+
+def parse_item(item: dict) -> tuple[str, str, dict]:
+    """
+    Content type, payload and render params of a batch item.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Batch item must be an object")
+    content_type = CONTENT_TYPES.get(str(item.get("type") or "png"))
+    if content_type is None:
+        raise ValueError(f"Unknown type: {item['type']}")
+    payload = str(item.get("data") or "")
+    if not payload:
+        raise ValueError("Empty data")
+    kwargs = {k: v for k, v in item.items() if k in _GEN_ARGS}
+    if "optimize" in kwargs:
+        kwargs["optimize"] = flag(kwargs["optimize"])
+    return content_type, payload, kwargs
+
+
+async def render_item(item: dict) -> tuple[str, bytes | str]:
+    content_type, payload, kwargs = parse_item(item)
+    while True:
+        try:
+            return content_type, await render_cached(content_type, payload, **kwargs)
+        except RenderQueueFull:
+            # a batch waits for the pool instead of failing the item
+            await asyncio.sleep(0.05)
+
+
+async def _render_indexed(index: int, item: dict) -> tuple[int, str | None, bytes | str | Exception]:
+    try:
+        return index, *await render_item(item)
+    except Exception as e:
+        return index, None, e
+
+
+_END = object()
+
+
+async def render_batch(items: AsyncIterator[dict], concurrency: int = BATCH_CONCURRENCY):
+    """
+    Yield (index, content type, body or exception) in completion order.
+
+    At most ``concurrency`` items are read ahead, so memory doesn't depend on the batch size. Reading the next
+    item races the renders, so finished ones are yielded while a slow input is still being read.
+    """
+    items = aiter(items)
+    pending = set()
+    reading = None
+    index = 0
+    try:
+        while True:
+            if reading is None and items is not None and len(pending) < concurrency:
+                reading = asyncio.ensure_future(anext(items, _END))
+            if not pending and reading is None:
+                break
+            done, _ = await asyncio.wait(pending | {reading} - {None}, return_when=asyncio.FIRST_COMPLETED)
+            if reading in done:
+                item, reading = reading.result(), None
+                if item is _END:
+                    items = None
+                else:
+                    pending.add(asyncio.create_task(_render_indexed(index, item)))
+                    index += 1
+            for task in done & pending:
+                pending.discard(task)
+                yield task.result()
+    finally:
+        for task in pending | {reading} - {None}:
+            task.cancel()
+
+
+def entry(index: int, content_type: str | None, body: bytes | str | Exception) -> tuple[str, bytes | str]:
+    """
+    File name and content of a batch result, failed items get an ``.error.txt`` file with the error.
+    """
+    if isinstance(body, Exception):
+        return f"{index:06d}.error.txt", f"{type(body).__name__}: {body}"
+    return f"{index:06d}.{EXTENSIONS[content_type]}", body
+
+
+def write_entry(archive: zipfile.ZipFile, index: int, content_type: str | None, body: bytes | str | Exception):
+    name, data = entry(index, content_type, body)
+    # PNG is compressed already
+    compression = zipfile.ZIP_STORED if content_type == "image/png" else zipfile.ZIP_DEFLATED
+    archive.writestr(name, data, compression)
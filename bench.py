@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import qrcode
+from qrcode.constants import ERROR_CORRECT_L, ERROR_CORRECT_M, ERROR_CORRECT_Q, ERROR_CORRECT_H
+from qrcode.util import MODE_8BIT_BYTE
+from base import get_bytes, get_svg_qr, get_ascii_qr, get_colors, hex_to_rgb
+from encoder import encode, BIT_LIMIT_TABLE, mode_sizes_for_version
+from render import render_png, render_svg, render_ascii
+
+LEVELS = {"L": ERROR_CORRECT_L, "M": ERROR_CORRECT_M, "Q": ERROR_CORRECT_Q, "H": ERROR_CORRECT_H}
+VERSIONS = (1, 10, 25, 40)
+VARIANTS = {
+    "default": {},
+    "no-border": {"border": 0},
+    "wide-border": {"border": 12},
+    "colored": {"color": "#336699", "background": "#ffeecc"},
+    "inverted": {"invert": True},
+}
+
+
+def payload_for_version(version: int, error_correction: int = ERROR_CORRECT_M) -> str:
+    """
+    Byte mode payload filling the given version completely.
+    """
+    bits = BIT_LIMIT_TABLE[error_correction][version] - 4 - mode_sizes_for_version(version)[MODE_8BIT_BYTE]
+    return "a" * (bits // 8)
+
+
+def timeit(fn, repeat: int) -> float:
+    fn()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+def bench_encoder(versions=range(1, 41), repeat: int = 5, error_correction: int = ERROR_CORRECT_M) -> list[dict]:
+    """
+    Best-of-``repeat`` encode time of ``qrcode.QRCode.make`` against ``encoder.encode``.
+    """
+    results = []
+    for version in versions:
+        data = payload_for_version(version, error_correction)
+
+        def reference():
+            qr = qrcode.QRCode(error_correction=error_correction, border=0)
+            qr.add_data(data)
+            qr.make(fit=True)
+
+        qrcode_time = timeit(reference, repeat)
+        encoder_time = timeit(lambda: encode.__wrapped__(data, error_correction), repeat)
+        results.append({
+            "version": version,
+            "qrcode_ms": ms(qrcode_time),
+            "encoder_ms": ms(encoder_time),
+            "speedup": round(qrcode_time / encoder_time, 2),
+        })
+    return results
+
+
+def bench_micro(versions=VERSIONS, levels=tuple(LEVELS), repeat: int = 5) -> list[dict]:
+    """
+    Per stage timings: uncached encode per version and level, each renderer per version and variant
+    on a ready matrix, and the uncached ``base`` functions end to end.
+    """
+    results = []
+    for version in versions:
+        for level in levels:
+            data = payload_for_version(version, LEVELS[level])
+            results.append({
+                "stage": "encode", "version": version, "level": level,
+                "ms": ms(timeit(lambda: encode.__wrapped__(data, LEVELS[level]), repeat)),
+            })
+
+        data = payload_for_version(version)
+        matrix = encode(data)
+        for variant, params in VARIANTS.items():
+            color, background = get_colors(params.get("color", "#000000"), params.get("background", "#ffffff"),
+                                           params.get("invert", False))
+            rgb = tuple(map(hex_to_rgb, (color, background)))
+            border = params.get("border", 4)
+            renders = {
+                "png": lambda: render_png(matrix, border, *rgb),
+                "svg": lambda: render_svg(matrix, border, color, background),
+                "ascii": lambda: render_ascii(matrix, params.get("border", 0), params.get("invert", False)),
+            }
+            for renderer, fn in renders.items():
+                body = fn()
+                results.append({
+                    "stage": "render", "renderer": renderer, "version": version, "variant": variant,
+                    "ms": ms(timeit(fn, repeat)), "bytes": len(body),
+                })
+
+        for renderer, fn in (("png", get_bytes), ("svg", get_svg_qr), ("ascii", get_ascii_qr)):
+            def uncached():
+                encode.cache_clear()
+                fn(data)
+
+            results.append({
+                "stage": "end-to-end", "renderer": renderer, "version": version,
+                "ms": ms(timeit(uncached, repeat)),
+            })
+    return results
+
+
+async def _bench_http(path: str, payloads, concurrency: int, requests: int) -> dict:
+    import aiohttp
+    from aiohttp.test_utils import TestServer
+    from web import make_app
+
+    server = TestServer(make_app())
+    await server.start_server()
+    latencies = []
+    statuses: dict[int, int] = {}
+    counter = iter(range(requests))
+
+    async def client(session: aiohttp.ClientSession):
+        for i in counter:
+            start = time.perf_counter()
+            async with session.get(server.make_url(path), params={"data": payloads(i)}) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+            # warms the render pool up
+            await (await session.get(server.make_url(path), params={"data": "warm up"})).read()
+            start = time.perf_counter()
+            await asyncio.gather(*(client(session) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+    finally:
+        await server.close()
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {
+        "path": path, "concurrency": concurrency, "requests": requests, "statuses": statuses,
+        "rps": round(requests / elapsed, 1), "p50_ms": ms(p50), "p99_ms": ms(p99),
+    }
+
+
+def bench_macro(concurrency: int = 32, requests: int = 2000, version: int = 10) -> list[dict]:
+    """
+    Throughput and latency of ``create_app`` served in-process to a local aiohttp client.
+
+    "hot" repeats one payload, "cold" makes every payload unique so each request renders.
+    """
+    base_payload = payload_for_version(version)[:-8]
+    modes = {"hot": lambda i: base_payload, "cold": lambda i: f"{base_payload}{i:08d}"}
+    results = []
+    for path in ("/qr/png", "/qr/svg", "/qr/ascii"):
+        for mode, payloads in modes.items():
+            result = asyncio.run(_bench_http(path, payloads, concurrency, requests))
+            results.append({"mode": mode, "version": version, **result})
+    return results
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "render_executor": os.getenv("RENDER_EXECUTOR", "process"),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QR renderer and HTTP benchmarks, results are printed as JSON")
+    parser.add_argument("suites", nargs="*", choices=("encoder", "micro", "macro"), default=["micro", "macro"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--versions", type=int, nargs="*", default=None)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("-o", "--output", help="write to a file instead of stdout")
+    args = parser.parse_args()
+
+    report = {"environment": environment()}
+    if "encoder" in args.suites:
+        report["encoder"] = bench_encoder(args.versions or range(1, 41), args.repeat)
+    if "micro" in args.suites:
+        report["micro"] = bench_micro(args.versions or VERSIONS, repeat=args.repeat)
+    if "macro" in args.suites:
+        report["macro"] = bench_macro(args.concurrency, args.requests)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
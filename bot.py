@@ -1,86 +1,330 @@
+import asyncio
+import hmac
+import logging
 import os
 import shlex
+import signal
+from io import BytesIO
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types, executor
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import Message
-from base import *
+from aiogram.utils.exceptions import WrongFileIdentifier, WrongRemoteFileIdSpecified
+from cache import render_cached, render_key, key_digest
+from encoder import fit, DataTooLong
+from file_ids import FileIdCache
+from keyboard import KeyboardState, Prerenderer, make_keyboard, DEFAULT_BORDER
+from metrics import registry, CallbackGauge
 
+logger = logging.getLogger(__name__)
 
-def create_bot():
+
+def create_dispatcher() -> Dispatcher:
     TOKEN = os.getenv("TOKEN")
+    # a local Bot API server, or a fake one in tests
+    server = os.getenv("BOT_API_SERVER")
 
-    bot = Bot(TOKEN)
+    bot = Bot(TOKEN, server=TelegramAPIServer.from_base(server) if server else TELEGRAM_PRODUCTION)
 
     dp = Dispatcher(bot)
+    file_ids = FileIdCache.from_env(TOKEN)
+
+    prerenderer = Prerenderer.from_env()
+    registry.register(CallbackGauge(
+        "qr_bot_prerender_total", "Keyboard taps by whether their code was prerendered",
+        lambda: {("hit",): prerenderer.hits, ("miss",): prerenderer.misses}, ("result",), type="counter",
+    ))
+
+    async def send_photo(send, payload: str, body: bytes | None = None, **params):
+        """
+        ``send(photo)`` with the file_id of the same QR code sent before, uploading it otherwise.
+        """
+        key = render_key("image/png", payload, **params)
+        file_id = file_ids.get(key)
+        if file_id is not None:
+            try:
+                return await send(file_id)
+            except (WrongFileIdentifier, WrongRemoteFileIdSpecified):
+                file_ids.discard(key)
+        body = body or await render_cached("image/png", payload, **params)
+        sent = await send(types.InputFile(BytesIO(body)))
+        if isinstance(sent, Message) and sent.photo:
+            file_ids.put(key, sent.photo[-1].file_id)
+        return sent
 
     @dp.callback_query_handler()
     async def bt_handler(cq: types.callback_query.CallbackQuery):
+        await cq.answer()
         message = cq.message
-        param, new_value = cq.data.split("=")
-        if param == "none":
+        # buttons of messages sent by older versions carry no state
+        state = KeyboardState.parse(cq.data)
+        if state is None:
             return
         command = message.reply_to_message.get_command(True)
-        kb = message.reply_markup
-        bts = kb['inline_keyboard']
-        match param:
-            case 'invert':
-                bt = bts[0][0]
-                bt.callback_data = f"invert={'' if new_value else 1}"
-            case 'border':
-                bt = bts[1]
-                new_value = int(new_value)
-                bt[0].callback_data = f"border={new_value - 1 if new_value >= 0 else 0}"
-                bt[1].text = f"border={new_value}"
-                bt[2].callback_data = f"border={new_value + 1}"
-        params = {
-            "border": bts[1][1].text.split("=")[1],
-            "invert": bool(bts[0][0].callback_data.split("=")[1])
-        }
+        payload = message.reply_to_message.get_args()
+        kb = make_keyboard(command, state)
+        body = prerenderer.get(message, state)
 
         if command == "qr":
-            code = get_bytes(message.reply_to_message.get_args(), **params)
-
-            await message.edit_media(types.InputMediaPhoto(types.InputFile(code)), reply_markup=kb)
+            await send_photo(
+                lambda photo: message.edit_media(types.InputMediaPhoto(photo), reply_markup=kb),
+                payload, body, **state.params,
+            )
         elif command == "ascii":
-            code = get_ascii_qr(message.reply_to_message.get_args(), **params)
+            code = body or await render_cached("text/plain", payload, **state.params)
 
             await message.edit_text(f"```\n{code}```", parse_mode="markdown", reply_markup=kb)
+        prerenderer.schedule(message, command, payload, state)
+
+    batch_lines = int(os.getenv("BOT_BATCH_LINES", "50"))
+    chat_concurrency = int(os.getenv("BOT_CHAT_CONCURRENCY", "2"))
+    # semaphore and number of batches using it, per chat
+    chat_limits: dict[int, list] = {}
+
+    async def render_photo(limit: asyncio.Semaphore, line: str) -> tuple[tuple, str | types.InputFile]:
+        key = render_key("image/png", line)
+        file_id = file_ids.get(key)
+        if file_id is not None:
+            return key, file_id
+        async with limit:
+            return key, types.InputFile(BytesIO(await render_cached("image/png", line)))
+
+    async def send_group(message: Message, limit: asyncio.Semaphore, lines: list[str], photos: list):
+        if len(photos) == 1:
+            # a media group needs two items at least
+            return [await send_photo(lambda photo: message.reply_photo(photo, caption=lines[0]), lines[0])]
+        try:
+            sent = await message.reply_media_group(
+                [types.InputMediaPhoto(photo, caption=line) for line, (_, photo) in zip(lines, photos)],
+            )
+        except (WrongFileIdentifier, WrongRemoteFileIdSpecified):
+            for key, photo in photos:
+                if isinstance(photo, str):
+                    file_ids.discard(key)
+            photos = await asyncio.gather(*(render_photo(limit, line) for line in lines))
+            sent = await message.reply_media_group(
+                [types.InputMediaPhoto(photo, caption=line) for line, (_, photo) in zip(lines, photos)],
+            )
+        for (key, photo), sent_message in zip(photos, sent):
+            if not isinstance(photo, str) and sent_message.photo:
+                file_ids.put(key, sent_message.photo[-1].file_id)
+        return sent
+
+    async def on_qr_batch(message: Message, lines: list[str]):
+        """
+        One code per line, rendered concurrently up to BOT_CHAT_CONCURRENCY at a time per chat
+        and sent as media groups of 10. Lines beyond BOT_BATCH_LINES are skipped.
+        """
+        skipped = max(len(lines) - batch_lines, 0)
+        lines = lines[:batch_lines]
+        entry = chat_limits.setdefault(message.chat.id, [asyncio.Semaphore(chat_concurrency), 0])
+        entry[1] += 1
+        tasks = []
+        try:
+            tasks = [asyncio.ensure_future(render_photo(entry[0], line)) for line in lines]
+            failed = []
+            for start in range(0, len(lines), 10):
+                results = await asyncio.gather(*tasks[start:start + 10], return_exceptions=True)
+                chunk = [(line, result) for line, result in zip(lines[start:start + 10], results)
+                         if not isinstance(result, Exception)]
+                failed.extend(start + i + 1 for i, result in enumerate(results) if isinstance(result, Exception))
+                if chunk:
+                    await send_group(message, entry[0], [line for line, _ in chunk], [result for _, result in chunk])
+            if failed:
+                await message.reply(f"Could not make codes of lines {', '.join(map(str, failed))}")
+            if skipped:
+                await message.reply(f"Skipped the last {skipped} lines, up to {batch_lines} are made at once")
+        finally:
+            for task in tasks:
+                task.cancel()
+            entry[1] -= 1
+            if not entry[1]:
+                del chat_limits[message.chat.id]
 
     @dp.message_handler(commands=["qr"], regexp=r"^(\/qr)(\s\S+)+(\s+)?$")
     async def on_qr(message: Message) -> None:
         payload = message.get_args()
+        lines = [line.strip() for line in payload.splitlines() if line.strip()]
 
-        if len(payload) > 0:
-            bytes_img = get_bytes(payload)
-
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("invert", callback_data="invert=1"))
-            kb.add(
-                types.InlineKeyboardButton("-", callback_data="border=3"),
-                types.InlineKeyboardButton("border: 0", callback_data="none"),
-                types.InlineKeyboardButton("+", callback_data="border=5"),
-            )
+        # structured payloads such as vCards span lines but are a single code
+        if len(lines) > 1 and not payload.lstrip().startswith("BEGIN:"):
+            await on_qr_batch(message, lines)
+        elif len(payload) > 0:
+            state = KeyboardState(DEFAULT_BORDER["qr"], False)
+            kb = make_keyboard("qr", state)
 
-            await message.reply_photo(types.InputFile(bytes_img), caption=payload, reply_markup=kb)
+            sent = await send_photo(
+                lambda photo: message.reply_photo(photo, caption=payload, reply_markup=kb), payload, **state.params,
+            )
+            prerenderer.schedule(sent, "qr", payload, state)
 
     @dp.message_handler(commands=["ascii"], regexp=r"^(\/ascii)(\s\S+)+(\s+)?$")
     async def on_ascii(message: Message) -> None:
         payload = message.get_args()
 
         if len(payload) > 0:
-            code = get_ascii_qr(payload)
-
-            kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("invert", callback_data="invert=1"))
-            kb.add(
-                types.InlineKeyboardButton("-", callback_data="border=0"),
-                types.InlineKeyboardButton("border=0", callback_data="none"),
-                types.InlineKeyboardButton("+", callback_data="border=1"),
-            )
+            state = KeyboardState(DEFAULT_BORDER["ascii"], False)
+            code = await render_cached("text/plain", payload, **state.params)
+
+            kb = make_keyboard("ascii", state)
+
+            sent = await message.reply(f"```\n{code}```", parse_mode="markdown", reply_markup=kb)
+            prerenderer.schedule(sent, "ascii", payload, state)
 
-            await message.reply(f"```\n{code}```", parse_mode="markdown", reply_markup=kb)
+    # inline photo results must be uploaded already, codes not sent before are uploaded to this chat for a file_id
+    storage_chat = os.getenv("BOT_STORAGE_CHAT")
+    if not storage_chat:
+        logger.warning("BOT_STORAGE_CHAT is not set, inline queries only get photos of codes sent before")
+    inline_debounce = float(os.getenv("BOT_INLINE_DEBOUNCE", "0.3"))
+    inline_cache_time = int(os.getenv("BOT_INLINE_CACHE_TIME", "300"))
+    inline_tasks: dict[int, asyncio.Task] = {}
+
+    async def stored_photo(key: tuple, text: str, invert: bool) -> str | None:
+        file_id = file_ids.get(key)
+        if file_id is not None or not storage_chat:
+            return file_id
+        body = await render_cached("image/png", text, invert=invert)
+        sent = await dp.bot.send_photo(storage_chat, types.InputFile(BytesIO(body)), disable_notification=True)
+        file_ids.put(key, sent.photo[-1].file_id)
+        return sent.photo[-1].file_id
+
+    async def inline_results(text: str) -> list[types.InlineQueryResult]:
+        """
+        PNG, inverted PNG and ASCII variants of ``text``, rendered and uploaded concurrently.
+        """
+        try:
+            fit(text)
+        except DataTooLong:
+            return []
+        keys = {invert: render_key("image/png", text, invert=invert) for invert in (False, True)}
+        code, *photos = await asyncio.gather(
+            render_cached("text/plain", text),
+            *(stored_photo(key, text, invert) for invert, key in keys.items()),
+            return_exceptions=True,
+        )
+        if isinstance(code, BaseException):
+            raise code
+        results = []
+        for (invert, key), file_id in zip(keys.items(), photos):
+            if isinstance(file_id, Exception):
+                logger.warning("Could not upload an inline photo to chat %s: %s", storage_chat, file_id)
+            elif file_id is not None:
+                results.append(types.InlineQueryResultCachedPhoto(
+                    id=f"png:{key_digest(key)}", photo_file_id=file_id,
+                    title="QR code, inverted" if invert else "QR code",
+                ))
+        text_message = f"```\n{code}```"
+        # longer ones don't fit in a message
+        if len(text_message) <= 4096:
+            results.append(types.InlineQueryResultArticle(
+                id=f"ascii:{key_digest(render_key('text/plain', text))}", title="ASCII", description=text,
+                input_message_content=types.InputTextMessageContent(text_message, parse_mode="markdown"),
+            ))
+        return results
+
+    async def answer_inline(query: types.InlineQuery):
+        # a newer query of the same user cancels this one while it waits or renders
+        await asyncio.sleep(inline_debounce)
+        try:
+            await query.answer(await inline_results(query.query), cache_time=inline_cache_time)
+        except (WrongFileIdentifier, WrongRemoteFileIdSpecified):
+            for invert in (False, True):
+                file_ids.discard(render_key("image/png", query.query, invert=invert))
+            await query.answer(await inline_results(query.query), cache_time=inline_cache_time)
+
+    @dp.inline_handler()
+    async def on_inline(query: types.InlineQuery) -> None:
+        user = query.from_user.id
+        previous = inline_tasks.pop(user, None)
+        if previous is not None:
+            previous.cancel()
+        if not query.query:
+            return
+        task = inline_tasks[user] = asyncio.create_task(answer_inline(query))
+        try:
+            await task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+        finally:
+            if inline_tasks.get(user) is task:
+                del inline_tasks[user]
 
     @dp.message_handler()
     async def on_message(message: Message) -> None:
         await message.reply(message.text)
 
-    executor.start_polling(dp, skip_updates=True)
+    dp["file_ids"] = file_ids
+    return dp
+
+
+def create_bot():
+    dp = create_dispatcher()
+
+    async def on_shutdown(dp: Dispatcher):
+        dp["file_ids"].save()
+
+    # the executor only stops cleanly on KeyboardInterrupt, a supervisor stops its children with SIGTERM
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    executor.start_polling(dp, skip_updates=True, on_shutdown=on_shutdown)
+
+
+def setup_webhook(app: web.Application, dp: Dispatcher | None = None):
+    """
+    Serve bot updates from ``app``, sharing its loop and render pool.
+
+    Telegram posts updates to BOT_WEBHOOK_PATH, they are acknowledged at once and handled in the background,
+    BOT_UPDATE_CONCURRENCY at a time. Up to BOT_UPDATE_QUEUE more wait, beyond that Telegram gets a 503
+    and delivers the update again later. The webhook is registered at BOT_WEBHOOK_URL on startup when set.
+    """
+    dp = dp or create_dispatcher()
+    path = os.getenv("BOT_WEBHOOK_PATH", "/bot/webhook")
+    url = os.getenv("BOT_WEBHOOK_URL")
+    secret = os.getenv("BOT_WEBHOOK_SECRET", "")
+    concurrency = int(os.getenv("BOT_UPDATE_CONCURRENCY", "16"))
+    queue_size = int(os.getenv("BOT_UPDATE_QUEUE", "256"))
+    limit = asyncio.Semaphore(concurrency)
+    tasks: set[asyncio.Task] = set()
+
+    async def process(update: types.Update):
+        async with limit:
+            Bot.set_current(dp.bot)
+            Dispatcher.set_current(dp)
+            try:
+                await dp.process_update(update)
+            except Exception:
+                logger.exception("Update %s failed", update.update_id)
+
+    async def on_update(req: web.Request):
+        token = req.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if secret and not hmac.compare_digest(token.encode(), secret.encode()):
+            return web.HTTPForbidden()
+        if len(tasks) >= concurrency + queue_size:
+            return web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+        try:
+            update = types.Update(**await req.json())
+        except (ValueError, TypeError):
+            return web.HTTPBadRequest()
+        task = asyncio.create_task(process(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.Response(text="ok")
+
+    async def on_startup(app: web.Application):
+        if url:
+            await dp.bot.set_webhook(url, max_connections=concurrency, secret_token=secret or None)
+
+    async def on_cleanup(app: web.Application):
+        if tasks:
+            await asyncio.wait(tasks, timeout=10)
+        dp["file_ids"].save()
+        await (await dp.bot.get_session()).close()
+
+    app.router.add_post(path, on_update)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    registry.register(CallbackGauge(
+        "qr_bot_updates_pending", "Bot updates received through the webhook and not handled yet",
+        lambda: {(): len(tasks)},
+    ))
@@ -0,0 +1,222 @@
+import argparse
+import csv
+import io
+import json
+import os
+import signal
+import sys
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator
+from base import _GEN_ARGS
+from batch import parse_item, entry, write_entry
+from pool import _render
+
+
+def iter_rows(stream: io.TextIOBase, format: str) -> Iterator[dict | str]:
+    if format == "csv":
+        for row in csv.DictReader(stream):
+            # cells are strings, style columns like invert=true or border=2 are read as JSON values
+            yield {key: _cell(value) if key in _GEN_ARGS else value for key, value in row.items() if value}
+        return
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # passed on as is, so the broken line gets its own error entry
+                yield line
+
+
+def _cell(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def render_row(index: int, item: dict | str) -> tuple[int, str | None, bytes | str | Exception]:
+    try:
+        content_type, payload, kwargs = parse_item(item)
+        return index, content_type, _render(content_type, payload, kwargs)
+    except Exception as e:
+        return index, None, e
+
+
+def _ignore_interrupt():
+    # the parent stops the run on Ctrl+C and closes the output cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Checkpoint:
+    """
+    Append-only list of the indices of rows whose output is safely written.
+    """
+
+    def __init__(self, path: str, resume: bool):
+        self.done: set[int] = set()
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.done.update(int(line) for line in f if line.strip())
+        self._file = open(path, "a" if resume else "w")
+
+    def add(self, indices):
+        self._file.writelines(f"{index}\n" for index in indices)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class DirectoryWriter:
+    def __init__(self, path: str, checkpoint: Checkpoint):
+        self.path = path
+        self.checkpoint = checkpoint
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, index: int, content_type: str | None, body: bytes | str | Exception):
+        name, data = entry(index, content_type, body)
+        file = os.path.join(self.path, name)
+        with open(file + ".tmp", "wb") as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+        os.replace(file + ".tmp", file)
+        if not isinstance(body, Exception):
+            self.checkpoint.add((index,))
+
+    def close(self):
+        pass
+
+
+class ZipWriter:
+    """
+    Entries are streamed to the archive, the checkpoint records them once it is closed. A resumed run writes
+    to the next free ``<name>.<n>.zip`` part, since an interrupted archive has no central directory.
+    """
+
+    def __init__(self, path: str, checkpoint: Checkpoint, resume: bool):
+        self.checkpoint = checkpoint
+        self.path = path
+        root, ext = os.path.splitext(path)
+        part = 0
+        while resume and os.path.exists(self.path):
+            part += 1
+            self.path = f"{root}.{part}{ext}"
+        self.archive = zipfile.ZipFile(self.path, "w")
+        self.indices: list[int] = []
+
+    def write(self, index: int, content_type: str | None, body: bytes | str | Exception):
+        write_entry(self.archive, index, content_type, body)
+        if not isinstance(body, Exception):
+            self.indices.append(index)
+
+    def close(self):
+        self.archive.close()
+        self.checkpoint.add(self.indices)
+
+
+class Progress:
+    def __init__(self, interval: float, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.start = self.last = time.perf_counter()
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    def update(self, body: bytes | str | Exception):
+        if isinstance(body, Exception):
+            self.failed += 1
+        else:
+            self.done += 1
+            self.bytes += len(body)
+        now = time.perf_counter()
+        if self.interval and now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def report(self, now: float):
+        self.stream.write(
+            f"{self.done} done, {self.failed} failed, {self.skipped} skipped,"
+            f" {self.done / max(now - self.start, 1e-9):.1f} codes/s\n"
+        )
+        self.stream.flush()
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        return (
+            f"{self.done} codes ({self.failed} failed, {self.skipped} skipped) in {elapsed:.2f}s:"
+            f" {self.done / max(elapsed, 1e-9):.1f} codes/s, {self.bytes / max(elapsed, 1e-9) / 1e6:.2f} MB/s"
+        )
+
+
+def run(rows, writer, checkpoint: Checkpoint, progress: Progress, workers: int, default_type: str):
+    """
+    Render the rows not in the checkpoint on a process pool, at most ``workers * 4`` at a time,
+    and write them in completion order.
+    """
+    window = workers * 4
+    pending = set()
+
+    def collect(futures):
+        for future in futures:
+            index, content_type, body = future.result()
+            writer.write(index, content_type, body)
+            progress.update(body)
+
+    with ProcessPoolExecutor(workers, initializer=_ignore_interrupt) as executor:
+        try:
+            for index, item in enumerate(rows):
+                if index in checkpoint.done:
+                    progress.skipped += 1
+                    continue
+                if isinstance(item, dict) and not item.get("type"):
+                    item["type"] = default_type
+                if len(pending) >= window:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                pending.add(executor.submit(render_row, index, item))
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render QR codes of CSV or NDJSON rows (data, type and style columns) into a ZIP or a directory",
+    )
+    parser.add_argument("input", help="CSV or NDJSON file, - for stdin")
+    parser.add_argument("output", help="a .zip archive or a directory")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="input format, guessed from the extension")
+    parser.add_argument("--type", default="png", choices=("png", "svg", "ascii"), help="for rows without a type")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--checkpoint", help="list of written rows, <output>.checkpoint by default")
+    parser.add_argument("--resume", action="store_true", help="skip the rows in the checkpoint")
+    parser.add_argument("--progress", type=float, default=1.0, help="seconds between progress lines, 0 to disable")
+    args = parser.parse_args(argv)
+
+    format = args.format or ("csv" if args.input.lower().endswith(".csv") else "ndjson")
+    checkpoint = Checkpoint(args.checkpoint or args.output.rstrip("/") + ".checkpoint", args.resume)
+    if args.output.lower().endswith(".zip"):
+        writer = ZipWriter(args.output, checkpoint, args.resume)
+    else:
+        writer = DirectoryWriter(args.output, checkpoint)
+    progress = Progress(args.progress)
+    stream = sys.stdin if args.input == "-" else open(args.input, newline="", encoding="utf-8")
+    try:
+        run(iter_rows(stream, format), writer, checkpoint, progress, args.workers, args.type)
+    except KeyboardInterrupt:
+        print("Interrupted, run again with --resume to continue", file=sys.stderr)
+    finally:
+        writer.close()
+        checkpoint.close()
+        stream.close()
+        print(progress.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
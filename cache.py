@@ -0,0 +1,395 @@
+import asyncio
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from base import get_colors, flag
+from pool import get_pool
+from encoder import fit
+from render import compress_variants, png_raw_size, COMPRESSORS, COMPRESSIBLE, PNG_STREAM_BYTES
+from metrics import FORMATS, observe_render, registry, CallbackGauge
+
+logger = logging.getLogger(__name__)
+
+RenderKey = tuple[str, str, int, bool, str | None, str | None, bool, int | None]
+# precompressed variants are cached under the key followed by their content coding
+# bump whenever a renderer changes its output, so clients drop stale ETags
+RENDER_REVISION = 1
+
+
+def render_key(content_type: str, payload: str, border=None, invert=False, color="#000000", background="#ffffff",
+               optimize=False, box_size=None, **kwargs) -> RenderKey:
+    """
+    Canonical cache key, equal for every set of params producing the same output.
+    """
+    if content_type == "text/plain":
+        return payload, content_type, int(border or 0), bool(invert), None, None, flag(optimize), None
+    color, background = get_colors(color, background, invert)
+    box_size = int(box_size or 10) if content_type == "image/png" else None
+    return payload, content_type, int(border or 4), False, color, background, flag(optimize), box_size
+
+
+def key_digest(key: RenderKey) -> str:
+    return hashlib.sha256(repr((RENDER_REVISION, key)).encode()).hexdigest()[:32]
+
+
+def body_size(body: bytes | str) -> int:
+    return len(body) if isinstance(body, bytes) else len(body.encode())
+
+
+class RenderCache:
+    """
+    LRU cache of rendered bodies bounded by their total size in bytes, with optional TTL.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float | None = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[RenderKey, tuple[bytes | str, int, float]] = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "RenderCache":
+        ttl = float(os.getenv("RENDER_CACHE_TTL", "0"))
+        return cls(
+            max_bytes=int(os.getenv("RENDER_CACHE_BYTES", str(64 * 1024 * 1024))),
+            ttl=ttl if ttl > 0 else None,
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: RenderKey, count: bool = True) -> bytes | str | None:
+        """
+        ``count=False`` leaves the hit and miss counters to the caller, for lookups of precompressed variants.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += count
+            return None
+        body, size, expires = entry
+        if expires and expires < time.monotonic():
+            self._pop(key)
+            self.misses += count
+            return None
+        self._entries.move_to_end(key)
+        self.hits += count
+        return body
+
+    def put(self, key: RenderKey, body: bytes | str):
+        size = body_size(body)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._pop(key)
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        self._entries[key] = (body, size, expires)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: RenderKey):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self), "bytes": self.size}
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one running call instead of starting their own.
+
+    A waiter being cancelled doesn't cancel the shared call, an error is raised in every waiter.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls: dict[RenderKey, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _done(self, key: RenderKey, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # retrieved here in case every waiter was cancelled
+            future.exception()
+
+    async def do(self, key: RenderKey, fn):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+
+class DiskCache:
+    """
+    Content-addressed store of rendered bodies shared by every process on the host.
+
+    Entries live in ``<path>/<digest[:2]>/<digest>`` as a JSON header line with the kind and the key,
+    followed by the body. Files are written to a temporary name and renamed, so readers never see
+    a partial entry, and are read through mmap. Hits refresh the mtime, which orders the eviction
+    once the directory grows over ``max_bytes``.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._evicting = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._scan())
+
+    @classmethod
+    def from_env(cls) -> "DiskCache | None":
+        path = os.getenv("RENDER_DISK_CACHE")
+        if not path:
+            return None
+        return cls(path, max_bytes=int(os.getenv("RENDER_DISK_CACHE_BYTES", str(1024 * 1024 * 1024))))
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _scan(self):
+        """
+        (file, size, mtime) of every entry, leftovers of interrupted writes are removed.
+        """
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                    if entry.name.startswith(".tmp"):
+                        if stat.st_mtime < time.time() - 3600:
+                            os.unlink(entry.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    @staticmethod
+    def _read(file: str) -> tuple[list, bytes | str]:
+        with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            split = mm.find(b"\n")
+            header = json.loads(mm[:split])
+            body = mm[split + 1:]
+        kind, *key = header
+        return key, body.decode() if kind == "s" else body
+
+    def get(self, key: RenderKey, count: bool = True) -> bytes | str | None:
+        file = self._file(key_digest(key))
+        try:
+            stored_key, body = self._read(file)
+            os.utime(file)
+        except (FileNotFoundError, ValueError):
+            self.misses += count
+            return None
+        if tuple(stored_key) != key:
+            self.misses += count
+            return None
+        self.hits += count
+        return body
+
+    def put(self, key: RenderKey, body: bytes | str):
+        file = self._file(key_digest(key))
+        header = json.dumps(["s" if isinstance(body, str) else "b", *key]).encode()
+        data = header + b"\n" + (body.encode() if isinstance(body, str) else body)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(file))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until 90% of ``max_bytes`` is used.
+
+        The size is recounted from the directory, as other processes write to it too.
+        """
+        if not self._evicting.acquire(blocking=False):
+            return
+        try:
+            entries = sorted(self._scan(), key=lambda entry: entry[2])
+            size = sum(size for _, size, _ in entries)
+            for file, file_size, _ in entries:
+                if size <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.unlink(file)
+                except FileNotFoundError:
+                    pass
+                size -= file_size
+            self.size = size
+        finally:
+            self._evicting.release()
+
+    def warm_up(self, cache: RenderCache, count: int):
+        """
+        Load the ``count`` most recently used entries into the in-memory cache.
+        """
+        entries = sorted(self._scan(), key=lambda entry: entry[2], reverse=True)[:count]
+        for file, _, _ in reversed(entries):
+            try:
+                key, body = self._read(file)
+            except (FileNotFoundError, ValueError):
+                continue
+            # the name is the digest of the key and RENDER_REVISION, entries of older revisions are skipped
+            if os.path.basename(file) != key_digest(tuple(key)):
+                continue
+            cache.put(tuple(key), body)
+
+
+render_cache = RenderCache.from_env()
+disk_cache = DiskCache.from_env()
+in_flight = SingleFlight()
+
+
+registry.register(CallbackGauge(
+    "qr_cache_lookups_total", "Render cache lookups by tier and result",
+    lambda: {
+        ("memory", "hit"): render_cache.hits, ("memory", "miss"): render_cache.misses,
+        **({("disk", "hit"): disk_cache.hits, ("disk", "miss"): disk_cache.misses} if disk_cache else {}),
+    },
+    ("tier", "result"), type="counter",
+))
+registry.register(CallbackGauge(
+    "qr_cache_bytes", "Size of cached bodies by tier",
+    lambda: {("memory",): render_cache.size, **({("disk",): disk_cache.size} if disk_cache else {})}, ("tier",),
+))
+registry.register(CallbackGauge(
+    "qr_coalesced_total", "Requests that awaited an identical render already in flight",
+    lambda: {(): in_flight.coalesced}, type="counter",
+))
+
+
+def warm_up():
+    count = int(os.getenv("RENDER_DISK_CACHE_WARM", "0"))
+    if disk_cache is not None and count:
+        disk_cache.warm_up(render_cache, count)
+
+
+def _disk_put(key: RenderKey, body: bytes | str, variants: dict[str, bytes]):
+    disk_cache.put(key, body)
+    for encoding, data in variants.items():
+        disk_cache.put((*key, encoding), data)
+
+
+def _disk_put_done(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Could not write to the disk cache", exc_info=future.exception())
+
+
+def _disk_get(key: RenderKey, content_type: str) -> tuple[bytes | str | None, dict[str, bytes]]:
+    """
+    Disk cache hit and the variants stored next to it, compressed and stored again when some are missing.
+    """
+    body = disk_cache.get(key)
+    if body is None or content_type not in COMPRESSIBLE:
+        return body, {}
+    variants = {encoding: disk_cache.get((*key, encoding), count=False) for encoding in COMPRESSORS}
+    if None in variants.values():
+        variants = compress_variants(content_type, body)
+        for encoding, data in variants.items():
+            disk_cache.put((*key, encoding), data)
+    return body, variants
+
+
+async def _render(key: RenderKey, content_type: str, payload: str,
+                  kwargs: dict) -> tuple[bytes | str, dict[str, bytes], dict]:
+    loop = asyncio.get_running_loop()
+    body, variants, timings = None, {}, {}
+    # file reads, fsync, compression and eviction stay off the event loop
+    if disk_cache is not None:
+        start = time.perf_counter()
+        body, variants = await loop.run_in_executor(None, _disk_get, key, content_type)
+        timings["disk"] = time.perf_counter() - start
+    if body is None:
+        body, rendered, variants = await get_pool().render(content_type, payload, **kwargs)
+        observe_render(FORMATS[content_type], rendered)
+        timings.update(rendered)
+        if disk_cache is not None:
+            loop.run_in_executor(None, _disk_put, key, body, variants).add_done_callback(_disk_put_done)
+    render_cache.put(key, body)
+    for encoding, data in variants.items():
+        render_cache.put((*key, encoding), data)
+    return body, variants, timings
+
+
+def check_png_size(payload: str, kwargs: dict):
+    """
+    Only the web server streams PNGs larger than PNG_STREAM_BYTES, the cache refuses to hold them.
+    """
+    version = kwargs.get("version") or fit(payload, optimize=flag(kwargs.get("optimize")))
+    if png_raw_size(version, int(kwargs.get("border") or 4), int(kwargs.get("box_size") or 10)) > PNG_STREAM_BYTES:
+        raise ValueError("Image is too large, use a smaller box_size or border")
+
+
+def preferred_encoding(content_type: str, accepted, available) -> str | None:
+    if content_type not in COMPRESSIBLE:
+        return None
+    return next((encoding for encoding in COMPRESSORS if encoding in accepted and encoding in available), None)
+
+
+async def render_encoded(content_type: str, payload: str, accepted: frozenset = frozenset(),
+                         timings: dict | None = None, **kwargs) -> tuple[bytes | str, str | None]:
+    """
+    Body in the preferred of the ``accepted`` content codings it was precompressed with and that coding,
+    or the plain body and None.
+
+    ``timings``, when given, receives the seconds spent in the memory cache lookup ("cache"), the disk cache
+    lookup ("disk") and the render stages of the pool, when they happened for this request.
+    """
+    start = time.perf_counter()
+    key = render_key(content_type, payload, **kwargs)
+    encoding = preferred_encoding(content_type, accepted, COMPRESSORS)
+    # counted once per request, as a hit when the variant is found
+    body = render_cache.get((*key, encoding), count=False) if encoding else None
+    if body is not None:
+        render_cache.hits += 1
+    else:
+        encoding = None
+        body = render_cache.get(key)
+    if timings is not None:
+        timings["cache"] = time.perf_counter() - start
+    if body is None:
+        if content_type == "image/png":
+            check_png_size(payload, kwargs)
+        body, variants, rendered = await in_flight.do(key, lambda: _render(key, content_type, payload, kwargs))
+        if timings is not None:
+            timings.update(rendered)
+        encoding = preferred_encoding(content_type, accepted, variants)
+        if encoding:
+            body = variants[encoding]
+    return body, encoding
+
+
+async def render_cached(content_type: str, payload: str, timings: dict | None = None, **kwargs) -> bytes | str:
+    return (await render_encoded(content_type, payload, frozenset(), timings, **kwargs))[0]
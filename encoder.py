@@ -0,0 +1,480 @@
+import os
+import re
+from bisect import bisect_left
+from functools import lru_cache
+from typing import NamedTuple
+import numpy as np
+from qrcode.base import RS_BLOCK_TABLE, RS_BLOCK_OFFSET
+from qrcode.constants import ERROR_CORRECT_M
+from metrics import stage
+from qrcode.util import (
+    ALPHA_NUM, MODE_NUMBER, MODE_ALPHA_NUM, MODE_8BIT_BYTE, MODE_SIZE_SMALL, MODE_SIZE_MEDIUM, MODE_SIZE_LARGE,
+    PATTERN_POSITION_TABLE, BCH_type_info, BCH_type_number,
+)
+
+# minimal run length split into its own numeric/alphanumeric segment, same as ``QRCode.add_data``
+OPTIMIZE_MINIMUM = 20
+PAD_BYTES = (0xEC, 0x11)
+
+# GF(256) with the QR primitive polynomial x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = np.zeros(512, dtype=np.int32)
+GF_LOG = np.zeros(256, dtype=np.int32)
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+GF_EXP[255:510] = GF_EXP[:255]
+del _x, _i
+
+_ALPHA_NUM_VALUES = np.full(256, -1, dtype=np.int32)
+_ALPHA_NUM_VALUES[np.frombuffer(ALPHA_NUM, dtype=np.uint8)] = np.arange(len(ALPHA_NUM))
+_RE_NUM = re.compile(rb"\d{%d,}" % OPTIMIZE_MINIMUM)
+_RE_ALPHA_NUM = re.compile(b"[" + re.escape(ALPHA_NUM) + b"]{%d,}" % OPTIMIZE_MINIMUM)
+_RE_NUM_SHORT = re.compile(rb"^\d+$")
+_RE_ALPHA_NUM_SHORT = re.compile(b"^[" + re.escape(ALPHA_NUM) + b"]+$")
+
+
+class DataTooLong(ValueError):
+    pass
+
+
+class Matrix(NamedTuple):
+    """
+    Immutable module matrix of a QR code without border, one byte per module (1 - dark).
+    """
+    size: int
+    modules: bytes
+
+    def row(self, r: int) -> bytes:
+        return self.modules[r * self.size:(r + 1) * self.size]
+
+    def rows(self):
+        for r in range(self.size):
+            yield self.row(r)
+
+
+def rs_blocks(version: int, error_correction: int) -> list[tuple[int, int]]:
+    """
+    (total, data) codeword counts of every Reed-Solomon block.
+    """
+    table = RS_BLOCK_TABLE[(version - 1) * 4 + RS_BLOCK_OFFSET[error_correction]]
+    return [(total, data) for i in range(0, len(table), 3) for total, data in [table[i + 1:i + 3]] * table[i]]
+
+
+# data capacity in bits, indexed by error correction level and version
+BIT_LIMIT_TABLE = [
+    [0] + [8 * sum(data for _, data in rs_blocks(version, error_correction)) for version in range(1, 41)]
+    for error_correction in range(4)
+]
+# (first version, count indicator sizes) of the three version ranges
+_MODE_SIZES = ((1, MODE_SIZE_SMALL), (10, MODE_SIZE_MEDIUM), (27, MODE_SIZE_LARGE))
+# numeric mode is the densest, longer payloads never fit whatever their content
+MAX_LENGTH = [(limits[40] - 4 - MODE_SIZE_LARGE[MODE_NUMBER]) * 3 // 10 for limits in BIT_LIMIT_TABLE]
+
+
+def mode_sizes_for_version(version: int) -> dict[int, int]:
+    return MODE_SIZE_SMALL if version < 10 else MODE_SIZE_MEDIUM if version < 27 else MODE_SIZE_LARGE
+
+
+def segments(data: bytes) -> list[tuple[int, bytes]]:
+    """
+    Split ``data`` into (mode, chunk) segments the way ``qrcode.util.optimal_data_chunks`` does.
+    """
+    if len(data) <= OPTIMIZE_MINIMUM:
+        num_pattern, alpha_pattern = _RE_NUM_SHORT, _RE_ALPHA_NUM_SHORT
+    else:
+        num_pattern, alpha_pattern = _RE_NUM, _RE_ALPHA_NUM
+    result = []
+    for is_num, chunk in _split(data, num_pattern):
+        if is_num:
+            result.append((MODE_NUMBER, chunk))
+        else:
+            result.extend(
+                (MODE_ALPHA_NUM if is_alpha else MODE_8BIT_BYTE, sub_chunk)
+                for is_alpha, sub_chunk in _split(chunk, alpha_pattern)
+            )
+    return result
+
+
+def _split(data: bytes, pattern: re.Pattern):
+    # searches the remainder each time, so anchored patterns behave like in qrcode
+    while data:
+        match = pattern.search(data)
+        if not match:
+            break
+        if match.start():
+            yield False, data[:match.start()]
+        yield True, match.group()
+        data = data[match.end():]
+    if data:
+        yield False, data
+
+
+def segment_bits(mode: int, chunk: bytes) -> int:
+    """
+    Size of the segment payload in bits, without the mode and count indicators.
+    """
+    if mode == MODE_NUMBER:
+        return len(chunk) // 3 * 10 + (0, 4, 7)[len(chunk) % 3]
+    if mode == MODE_ALPHA_NUM:
+        return len(chunk) // 2 * 11 + len(chunk) % 2 * 6
+    return len(chunk) * 8
+
+
+def best_version(segs: list[tuple[int, bytes]], error_correction: int) -> int:
+    """
+    Smallest version fitting the segments, looked up in the capacity table instead of trial encodes.
+    """
+    payload = sum(4 + segment_bits(mode, chunk) for mode, chunk in segs)
+    limits = BIT_LIMIT_TABLE[error_correction]
+    start = 1
+    for first, sizes in _MODE_SIZES:
+        if start < first:
+            continue
+        version = bisect_left(limits, payload + sum(sizes[mode] for mode, _ in segs), start)
+        if version > 40:
+            raise DataTooLong("Data does not fit in a version 40 QR code")
+        if mode_sizes_for_version(version) is sizes:
+            return version
+        start = version
+    raise DataTooLong("Data does not fit in a version 40 QR code")
+
+
+_MODES = (MODE_NUMBER, MODE_ALPHA_NUM, MODE_8BIT_BYTE)
+# bits per character in sixths, numeric (10/3) and alphanumeric (11/2) runs stay integral
+_CHAR_COSTS = (20, 33, 48)
+_NUMERIC_BYTES = frozenset(b"0123456789")
+_ALPHA_NUM_BYTES = frozenset(ALPHA_NUM)
+_INFINITY = 1 << 62
+
+
+def optimal_segments(data: bytes, sizes: dict[int, int]) -> tuple[list[tuple[int, bytes]], int]:
+    """
+    Segmentation of ``data`` with the fewest bits for the count indicator ``sizes`` of a version range,
+    and its size in bits. Dynamic programming over the mode of every byte.
+    """
+    if not data:
+        return [], 0
+    headers = [(4 + sizes[mode]) * 6 for mode in _MODES]
+    costs = None
+    sources = []
+    for byte in data:
+        allowed = (byte in _NUMERIC_BYTES, byte in _ALPHA_NUM_BYTES, True)
+        current = [_INFINITY] * 3
+        source = [0, 1, 2]
+        for mode in range(3):
+            if not allowed[mode]:
+                continue
+            if costs is None:
+                current[mode] = headers[mode] + _CHAR_COSTS[mode]
+                continue
+            for previous in range(3):
+                # a new segment starts at a whole bit
+                cost = costs[mode] if previous == mode else -(-costs[previous] // 6) * 6 + headers[mode]
+                if cost + _CHAR_COSTS[mode] < current[mode]:
+                    current[mode] = cost + _CHAR_COSTS[mode]
+                    source[mode] = previous
+        costs = current
+        sources.append(source)
+
+    mode = min(range(3), key=lambda m: costs[m])
+    bits = -(-costs[mode] // 6)
+    modes = bytearray(len(data))
+    for i in range(len(data) - 1, -1, -1):
+        modes[i] = mode
+        mode = sources[i][mode]
+    segs = []
+    start = 0
+    for i in range(1, len(data) + 1):
+        if i == len(data) or modes[i] != modes[start]:
+            segs.append((_MODES[modes[start]], data[start:i]))
+            start = i
+    return segs, bits
+
+
+def optimal_version(data: bytes, error_correction: int) -> tuple[list[tuple[int, bytes]], int]:
+    """
+    Optimal segments and the smallest version fitting them, each version range has its own optimum.
+    """
+    limits = BIT_LIMIT_TABLE[error_correction]
+    for first, sizes in _MODE_SIZES:
+        segs, bits = optimal_segments(data, sizes)
+        version = bisect_left(limits, bits, first)
+        if version <= 40 and mode_sizes_for_version(version) is sizes:
+            return segs, version
+    raise DataTooLong("Data does not fit in a version 40 QR code")
+
+
+def fit(data: str, error_correction: int = ERROR_CORRECT_M, optimize: bool = False) -> int:
+    """
+    Version ``data`` is encoded at, raises ``DataTooLong`` in linear time without encoding anything.
+    """
+    raw = data.encode("utf-8")
+    if len(raw) > MAX_LENGTH[error_correction]:
+        raise DataTooLong("Data does not fit in a version 40 QR code")
+    if optimize:
+        return optimal_version(raw, error_correction)[1]
+    return best_version(segments(raw), error_correction)
+
+
+def _int_bits(values: np.ndarray, length: int) -> np.ndarray:
+    return ((values[:, None] >> np.arange(length - 1, -1, -1)) & 1).astype(np.uint8).ravel()
+
+
+def _segment_bit_array(mode: int, chunk: bytes) -> np.ndarray:
+    raw = np.frombuffer(chunk, dtype=np.uint8)
+    if mode == MODE_8BIT_BYTE:
+        return np.unpackbits(raw)
+    if mode == MODE_NUMBER:
+        digits = raw.astype(np.int32) - ord("0")
+        full = len(digits) // 3 * 3
+        parts = [_int_bits(digits[:full].reshape(-1, 3) @ np.array([100, 10, 1], dtype=np.int32), 10)]
+        if full < len(digits):
+            rest = len(digits) - full
+            parts.append(_int_bits(np.array([int(chunk[full:])]), (0, 4, 7)[rest]))
+        return np.concatenate(parts)
+    values = _ALPHA_NUM_VALUES[raw]
+    full = len(values) // 2 * 2
+    parts = [_int_bits(values[:full].reshape(-1, 2) @ np.array([45, 1], dtype=np.int32), 11)]
+    if full < len(values):
+        parts.append(_int_bits(values[full:], 6))
+    return np.concatenate(parts)
+
+
+def data_codewords(segs: list[tuple[int, bytes]], version: int, error_correction: int) -> np.ndarray:
+    sizes = mode_sizes_for_version(version)
+    parts = []
+    for mode, chunk in segs:
+        parts.append(_int_bits(np.array([mode]), 4))
+        parts.append(_int_bits(np.array([len(chunk)]), sizes[mode]))
+        parts.append(_segment_bit_array(mode, chunk))
+    bits = np.concatenate(parts) if parts else np.zeros(0, dtype=np.uint8)
+    bit_limit = BIT_LIMIT_TABLE[error_correction][version]
+    if len(bits) > bit_limit:
+        raise DataTooLong(f"Code length overflow. Data size ({len(bits)}) > size available ({bit_limit})")
+    # terminator and zero bits up to a whole codeword
+    terminated = min(bit_limit, (len(bits) + min(bit_limit - len(bits), 4) + 7) // 8 * 8)
+    codewords = np.packbits(np.concatenate([bits, np.zeros(terminated - len(bits), dtype=np.uint8)]))
+    padding = np.resize(np.array(PAD_BYTES, dtype=np.uint8), bit_limit // 8 - len(codewords))
+    return np.concatenate([codewords, padding])
+
+
+@lru_cache(maxsize=None)
+def rs_generator(degree: int) -> np.ndarray:
+    """
+    Logarithms of the generator polynomial coefficients, leading coefficient excluded.
+    """
+    poly = np.array([1], dtype=np.int32)
+    for i in range(degree):
+        shifted = np.append(poly, 0)
+        product = np.zeros_like(shifted)
+        nonzero = poly != 0
+        product[1:][nonzero] = GF_EXP[GF_LOG[poly[nonzero]] + i]
+        poly = shifted ^ product
+    return GF_LOG[poly[1:]]
+
+
+def interleave(data: np.ndarray, version: int, error_correction: int) -> np.ndarray:
+    """
+    Split data codewords into blocks, append Reed-Solomon codewords and interleave them.
+    """
+    blocks = rs_blocks(version, error_correction)
+    ec_count = blocks[0][0] - blocks[0][1]
+    max_data = max(count for _, count in blocks)
+    aligned = np.zeros((len(blocks), max_data), dtype=np.int32)
+    # right aligned copy for the division: leading zero coefficients don't change
+    # the remainder, so every block is divided at once
+    dividends = np.zeros_like(aligned)
+    valid = np.zeros(aligned.shape, dtype=bool)
+    offset = 0
+    for i, (_, count) in enumerate(blocks):
+        aligned[i, :count] = dividends[i, max_data - count:] = data[offset:offset + count]
+        valid[i, :count] = True
+        offset += count
+    generator = rs_generator(ec_count)
+    remainder = np.zeros((len(blocks), ec_count), dtype=np.int32)
+    for i in range(max_data):
+        factor = dividends[:, i] ^ remainder[:, 0]
+        remainder[:, :-1] = remainder[:, 1:]
+        remainder[:, -1] = 0
+        nonzero = factor != 0
+        remainder[nonzero] ^= GF_EXP[GF_LOG[factor[nonzero]][:, None] + generator]
+    return np.concatenate([aligned.T[valid.T], remainder.T.ravel()]).astype(np.uint8)
+
+
+class Template(NamedTuple):
+    modules: np.ndarray
+    # function pattern cells, not touched by data or masks
+    reserved: np.ndarray
+    # data cells in placement order
+    data_rows: np.ndarray
+    data_cols: np.ndarray
+    # format info cells, bit i goes to both format_rows[:, i], format_cols[:, i]
+    format_rows: np.ndarray
+    format_cols: np.ndarray
+    version_bits: np.ndarray
+    masks: np.ndarray
+
+
+@lru_cache(maxsize=None)
+def template(version: int) -> Template:
+    """
+    Function patterns, data placement order and masks of a version, built once.
+    """
+    size = version * 4 + 17
+    modules = np.zeros((size, size), dtype=np.uint8)
+    reserved = np.zeros((size, size), dtype=bool)
+
+    for row, col in ((0, 0), (size - 7, 0), (0, size - 7)):
+        for r in range(-1, 8):
+            for c in range(-1, 8):
+                if 0 <= row + r < size and 0 <= col + c < size:
+                    reserved[row + r, col + c] = True
+                    modules[row + r, col + c] = (
+                        (0 <= r <= 6 and c in {0, 6}) or (0 <= c <= 6 and r in {0, 6})
+                        or (2 <= r <= 4 and 2 <= c <= 4)
+                    )
+    positions = PATTERN_POSITION_TABLE[version - 1]
+    for row in positions:
+        for col in positions:
+            if reserved[row, col]:
+                continue
+            for r in range(-2, 3):
+                for c in range(-2, 3):
+                    reserved[row + r, col + c] = True
+                    modules[row + r, col + c] = r in {-2, 2} or c in {-2, 2} or r == c == 0
+    for i in range(8, size - 8):
+        if not reserved[i, 6]:
+            reserved[i, 6] = True
+            modules[i, 6] = i % 2 == 0
+        if not reserved[6, i]:
+            reserved[6, i] = True
+            modules[6, i] = i % 2 == 0
+
+    vertical = [(i, 8) if i < 6 else (i + 1, 8) if i < 8 else (size - 15 + i, 8) for i in range(15)]
+    horizontal = [(8, size - i - 1) if i < 8 else (8, 15 - i) if i < 9 else (8, 15 - i - 1) for i in range(15)]
+    format_rows = np.array([[r for r, _ in vertical], [r for r, _ in horizontal]])
+    format_cols = np.array([[c for _, c in vertical], [c for _, c in horizontal]])
+    reserved[format_rows, format_cols] = True
+    # the dark module, reserved but left light while masks are scored
+    reserved[size - 8, 8] = True
+
+    version_bits = np.zeros((size, size), dtype=np.uint8)
+    if version >= 7:
+        bits = BCH_type_number(version)
+        for i in range(18):
+            version_bits[i // 3, i % 3 + size - 11] = version_bits[i % 3 + size - 11, i // 3] = (bits >> i) & 1
+            reserved[i // 3, i % 3 + size - 11] = reserved[i % 3 + size - 11, i // 3] = True
+
+    data_rows, data_cols = [], []
+    row, inc = size - 1, -1
+    for col in range(size - 1, 0, -2):
+        if col <= 6:
+            col -= 1
+        while 0 <= row < size:
+            for c in (col, col - 1):
+                if not reserved[row, c]:
+                    data_rows.append(row)
+                    data_cols.append(c)
+            row += inc
+        row -= inc
+        inc = -inc
+
+    i, j = np.indices((size, size))
+    masks = np.stack([
+        (i + j) % 2 == 0,
+        i % 2 == 0,
+        j % 3 == 0,
+        (i + j) % 3 == 0,
+        (i // 2 + j // 3) % 2 == 0,
+        (i * j) % 2 + (i * j) % 3 == 0,
+        ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+        ((i * j) % 3 + (i + j) % 2) % 2 == 0,
+    ]) & ~reserved
+    result = Template(modules, reserved, np.array(data_rows), np.array(data_cols), format_rows, format_cols,
+                      version_bits, masks.astype(np.uint8))
+    for array in result:
+        array.flags.writeable = False
+    return result
+
+
+_FINDER_LIKE = (0b10111010000, 0b00001011101)
+
+
+def penalties(candidates: np.ndarray) -> np.ndarray:
+    """
+    Penalty score of every matrix in the (masks, size, size) stack, the same as ``qrcode.util.lost_point``.
+    """
+    count, size, _ = candidates.shape
+    both = np.concatenate([candidates, candidates.transpose(0, 2, 1)], axis=1)
+
+    # rule 1: runs of five or more same-colored modules in rows and columns
+    changes = np.ones((count, size * 2, size + 1), dtype=bool)
+    changes[:, :, 1:-1] = both[:, :, 1:] != both[:, :, :-1]
+    boundaries = np.flatnonzero(changes)
+    lengths = np.diff(boundaries)
+    long = lengths >= 5
+    owner = boundaries[:-1][long] // (size * 2 * (size + 1))
+    score = np.bincount(owner, weights=lengths[long] - 2, minlength=count).astype(np.int64)
+
+    # rule 2: 2x2 blocks of one color
+    block = candidates[:, :-1, :-1]
+    uniform = (block == candidates[:, 1:, :-1]) & (block == candidates[:, :-1, 1:]) & (block == candidates[:, 1:, 1:])
+    score += uniform.sum(axis=(1, 2)) * 3
+
+    # rule 3: 1:1:3:1:1 finder-like patterns with four light modules on one side
+    wide = both.astype(np.int16)
+    windows = np.zeros((count, size * 2, size - 10), dtype=np.int16)
+    for k in range(11):
+        windows |= wide[:, :, k:size - 10 + k] << (10 - k)
+    score += ((windows == _FINDER_LIKE[0]) | (windows == _FINDER_LIKE[1])).sum(axis=(1, 2)) * 40
+
+    # rule 4: dark module proportion, kept in float to round exactly like qrcode
+    for i, dark in enumerate(candidates.sum(axis=(1, 2)).tolist()):
+        score[i] += int(abs(float(dark) / (size ** 2) * 100 - 50) / 5) * 10
+    return score
+
+
+def format_bits(error_correction: int, mask: int) -> np.ndarray:
+    bits = BCH_type_info((error_correction << 3) | mask)
+    return (bits >> np.arange(15)) & 1
+
+
+def build_matrix(codewords: np.ndarray, version: int, error_correction: int, mask: int | None = None) -> np.ndarray:
+    t = template(version)
+    size = version * 4 + 17
+    placed = t.modules.copy()
+    bits = np.unpackbits(codewords)[:len(t.data_rows)]
+    placed[t.data_rows[:len(bits)], t.data_cols[:len(bits)]] = bits
+    if mask is None:
+        # scored like qrcode does: format, version and dark module cells all light
+        with stage("mask"):
+            mask = int(np.argmin(penalties(placed[None] ^ t.masks)))
+    placed ^= t.masks[mask]
+    placed |= t.version_bits
+    placed[t.format_rows, t.format_cols] = format_bits(error_correction, mask)
+    placed[size - 8, 8] = 1
+    return placed
+
+
+@lru_cache(maxsize=int(os.getenv("ENCODE_CACHE_SIZE", "1024")))
+def encode(data: str, error_correction: int = ERROR_CORRECT_M, version: int | None = None,
+           optimize: bool = False) -> Matrix:
+    """
+    ``version`` skips the capacity lookup when already known from ``fit``. ``optimize`` uses the segmentation
+    with the fewest bits instead of the one of ``QRCode.add_data``, the symbol may be smaller than qrcode's.
+    """
+    raw = data.encode("utf-8")
+    if optimize and version:
+        segs = optimal_segments(raw, mode_sizes_for_version(version))[0]
+    elif optimize:
+        segs, version = optimal_version(raw, error_correction)
+    else:
+        segs = segments(raw)
+        version = version or best_version(segs, error_correction)
+    codewords = interleave(data_codewords(segs, version, error_correction), version, error_correction)
+    placed = build_matrix(codewords, version, error_correction)
+    return Matrix(len(placed), placed.tobytes())
@@ -0,0 +1,153 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """
+    LRU map of render keys to the ``file_id`` Telegram returned for the uploaded photo.
+
+    File ids are only valid for the bot that uploaded them, so the saved map records the bot id and
+    is ignored when loaded by another bot. Saved to ``path`` every ``save_every`` new entries, off the event loop
+    when called from one, and on ``save``. Workers of a prefork server share the file, saving merges with what
+    the others saved before.
+    """
+
+    def __init__(self, bot_id: str, max_entries: int = 10000, path: str | None = None, save_every: int = 100):
+        self.bot_id = bot_id
+        self.max_entries = max_entries
+        self.path = path
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self._unsaved = 0
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        # rejected file ids, kept until saved so the merge doesn't bring them back
+        self._discarded: dict[tuple, str] = {}
+        self._saving: asyncio.Future | None = None
+        if path:
+            self.load()
+
+    @classmethod
+    def from_env(cls, token: str) -> "FileIdCache":
+        return cls(
+            bot_id=token.split(":")[0],
+            max_entries=int(os.getenv("BOT_FILE_ID_CACHE_SIZE", "10000")),
+            path=os.getenv("BOT_FILE_ID_CACHE") or None,
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple) -> str | None:
+        file_id = self._entries.get(key)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return file_id
+
+    def put(self, key: tuple, file_id: str):
+        if self._entries.get(key) == file_id:
+            return
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        self._discarded.pop(key, None)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._unsaved += 1
+        if self.path and self._unsaved >= self.save_every and self._saving is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.save()
+                return
+            # the file lock may be held by another worker
+            self._saving = loop.run_in_executor(None, self._merge, *self._snapshot())
+            self._saving.add_done_callback(self._saved)
+
+    def discard(self, key: tuple):
+        file_id = self._entries.pop(key, None)
+        if file_id is not None:
+            self._discarded[key] = file_id
+            self._unsaved += 1
+
+    def _read(self) -> list[tuple[tuple, str]]:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logger.warning("Ignoring unreadable file_id cache %s", self.path)
+            return []
+        if data.get("bot") != self.bot_id:
+            return []
+        return [(tuple(key), file_id) for key, file_id in data["entries"][-self.max_entries:]]
+
+    def load(self):
+        self._entries.update(self._read())
+
+    def _snapshot(self) -> tuple[list[tuple[tuple, str]], dict[tuple, str]]:
+        entries, discarded = list(self._entries.items()), self._discarded
+        self._discarded = {}
+        self._unsaved = 0
+        return entries, discarded
+
+    def _merge(self, entries: list[tuple[tuple, str]], discarded: dict[tuple, str]) -> list[tuple[tuple, str]]:
+        """
+        Write ``entries`` over the saved ones and return the result, thread safe.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # serializes the read, merge and replace of the workers sharing the file
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # entries of this worker are the more recent ones
+            merged = OrderedDict((key, file_id) for key, file_id in self._read() if discarded.get(key) != file_id)
+            for key, file_id in entries:
+                merged.pop(key, None)
+                merged[key] = file_id
+            while len(merged) > self.max_entries:
+                merged.popitem(last=False)
+            fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"bot": self.bot_id, "entries": list(merged.items())}, f)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return list(merged.items())
+
+    def _adopt(self, merged: list[tuple[tuple, str]]):
+        # entries saved by other workers go before the ones of this worker, added or discarded meanwhile
+        entries = OrderedDict(
+            (key, file_id) for key, file_id in merged
+            if key not in self._entries and self._discarded.get(key) != file_id
+        )
+        entries.update(self._entries)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        self._entries = entries
+
+    def _saved(self, future: asyncio.Future):
+        self._saving = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error("Could not save the file_id cache", exc_info=future.exception())
+            self._unsaved += 1
+            return
+        self._adopt(future.result())
+
+    def save(self):
+        if not self.path or not self._unsaved:
+            return
+        self._adopt(self._merge(*self._snapshot()))
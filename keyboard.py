@@ -0,0 +1,113 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import NamedTuple
+from aiogram import types
+from cache import render_cached
+from pool import get_pool
+from render import MAX_BORDER
+
+# smallest border per command, a PNG border of 0 falls back to the default
+MIN_BORDER = {"qr": 1, "ascii": 0}
+DEFAULT_BORDER = {"qr": 4, "ascii": 0}
+CONTENT_TYPES = {"qr": "image/png", "ascii": "text/plain"}
+
+
+class KeyboardState(NamedTuple):
+    """
+    Params of the code shown in a message, carried whole by every button as ``s:<border>:<invert>``.
+    """
+    border: int
+    invert: bool
+
+    @classmethod
+    def parse(cls, data: str) -> "KeyboardState | None":
+        tag, *values = data.split(":")
+        if tag != "s" or len(values) != 2 or not all(value.isdigit() for value in values):
+            return None
+        return cls(int(values[0]), values[1] == "1")
+
+    def dump(self) -> str:
+        return f"s:{self.border}:{int(self.invert)}"
+
+    @property
+    def params(self) -> dict:
+        return {"border": self.border, "invert": self.invert}
+
+    def neighbours(self, command: str) -> list["KeyboardState"]:
+        """
+        States one tap away first, then two taps away on the border.
+        """
+        borders = (self.border - 1, self.border + 1, self.border - 2, self.border + 2)
+        return [self._replace(invert=not self.invert)] + [
+            self._replace(border=border) for border in borders if MIN_BORDER[command] <= border <= MAX_BORDER
+        ]
+
+
+def make_keyboard(command: str, state: KeyboardState) -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("invert", callback_data=state._replace(invert=not state.invert).dump()))
+    kb.add(
+        types.InlineKeyboardButton(
+            "-", callback_data=state._replace(border=state.border - 1).dump()
+            if state.border > MIN_BORDER[command] else "none",
+        ),
+        types.InlineKeyboardButton(f"border: {state.border}", callback_data="none"),
+        types.InlineKeyboardButton(
+            "+", callback_data=state._replace(border=state.border + 1).dump() if state.border < MAX_BORDER else "none",
+        ),
+    )
+    return kb
+
+
+class Prerenderer:
+    """
+    Renders the neighbouring keyboard states of recently sent messages in the background, so a tap is answered
+    from memory. Runs one render at a time and only while the render pool has idle workers, the states of the
+    ``max_messages`` most recent messages are kept.
+    """
+
+    def __init__(self, max_messages: int = 256):
+        self.max_messages = max_messages
+        self.hits = 0
+        self.misses = 0
+        self._messages: OrderedDict[tuple[int, int], dict[KeyboardState, asyncio.Task]] = OrderedDict()
+        self._limit = asyncio.Semaphore(1)
+
+    @classmethod
+    def from_env(cls) -> "Prerenderer":
+        return cls(int(os.getenv("BOT_PRERENDER_MESSAGES", "256")))
+
+    async def _render(self, content_type: str, payload: str, state: KeyboardState) -> bytes | str | None:
+        async with self._limit:
+            pool = get_pool()
+            if pool.pending >= pool.workers:
+                return None
+            return await render_cached(content_type, payload, **state.params)
+
+    def schedule(self, message: types.Message, command: str, payload: str, state: KeyboardState):
+        key = (message.chat.id, message.message_id)
+        self._drop(key)
+        tasks = self._messages[key] = {
+            neighbour: asyncio.create_task(self._render(CONTENT_TYPES[command], payload, neighbour))
+            for neighbour in state.neighbours(command)
+        }
+        for task in tasks.values():
+            # a failed prerender is only a miss later
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        while len(self._messages) > self.max_messages:
+            self._drop(next(iter(self._messages)))
+
+    def get(self, message: types.Message, state: KeyboardState) -> bytes | str | None:
+        task = self._messages.get((message.chat.id, message.message_id), {}).get(state)
+        if task is None or not task.done() or task.cancelled() or task.exception() is not None:
+            self.misses += 1
+            return None
+        body = task.result()
+        self.hits += body is not None
+        self.misses += body is None
+        return body
+
+    def _drop(self, key: tuple[int, int]):
+        for task in self._messages.pop(key, {}).values():
+            task.cancel()
@@ -1,9 +1,32 @@
+import argparse
 import logging
+import os
 from bot import create_bot
 from web import create_app
+from server import serve
 
 logging.basicConfig(level=logging.INFO)
 
 if __name__ == "__main__":
-    create_app()
-    create_bot()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prefork", action="store_true", default=os.getenv("SERVER_MODE") == "prefork",
+                        help="fork web workers sharing the port, the bot runs in its own supervised process")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of web workers in prefork mode, WEB_WORKERS or CPU count by default")
+    parser.add_argument("--no-bot", action="store_true", help="serve only the HTTP API")
+    parser.add_argument("--webhook", action="store_true", default=os.getenv("BOT_MODE") == "webhook",
+                        help="take bot updates through a webhook on the HTTP server instead of polling,"
+                             " single process only")
+    args = parser.parse_args()
+    with_bot = not args.no_bot and bool(os.getenv("TOKEN"))
+    webhook = with_bot and args.webhook
+    if webhook and args.prefork:
+        # the update queue, inline renders and chat rate limits are per process, workers would not share them
+        parser.error("--webhook can't be used with --prefork, the bot polls in its own process there")
+
+    if args.prefork:
+        serve(args.workers, extra=(create_bot,) if with_bot else ())
+    else:
+        create_app(stop=not with_bot or webhook, webhook=webhook)
+        if with_bot and not webhook:
+            create_bot()
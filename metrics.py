@@ -0,0 +1,214 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+VERSION_BUCKETS = (1, 2, 3, 5, 7, 10, 15, 20, 25, 30, 35, 40)
+FORMATS = {"image/png": "png", "image/svg+xml": "svg", "text/plain": "ascii"}
+
+_trace = threading.local()
+
+
+@contextmanager
+def collect():
+    """
+    Collect the ``stage`` timings of the current thread into the yielded dict.
+    """
+    _trace.timings = timings = {}
+    try:
+        yield timings
+    finally:
+        _trace.timings = None
+
+
+@contextmanager
+def stage(name: str):
+    timings = getattr(_trace, "timings", None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+def annotate(name: str, value):
+    timings = getattr(_trace, "timings", None)
+    if timings is not None:
+        timings[name] = value
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    Base of labeled metrics. Children are plain objects updated without locks,
+    a rare lost update from a render thread is fine for monitoring.
+    """
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self._samples())
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield self.name, _format_labels(self.label_names, values), child.value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class CallbackGauge(Metric):
+    """
+    Gauge read from ``fn`` at scrape time, ``fn`` returns {label values: value}.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, fn, labels: tuple = (), type: str = "gauge"):
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.type = type
+
+    def _samples(self):
+        for values, value in self.fn().items():
+            yield self.name, _format_labels(self.label_names, values), value
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.label_names, values, f'le="{bound}"'), cumulative
+            labels = _format_labels(self.label_names, values)
+            yield f"{self.name}_sum", labels, child.sum
+            yield f"{self.name}_count", labels, child.count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        return "\n".join(metric.expose() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "qr_stage_seconds", "Time spent per format and stage: encode (mask included), mask, render, write",
+    ("format", "stage"),
+))
+request_seconds = registry.register(Histogram(
+    "qr_request_seconds", "Time to answer a QR request, response write included", ("format",),
+))
+payload_bytes = registry.register(Histogram(
+    "qr_payload_bytes", "Size of the encoded payload", ("format",), SIZE_BUCKETS,
+))
+qr_version = registry.register(Histogram(
+    "qr_version", "Version of rendered QR codes", ("format",), VERSION_BUCKETS,
+))
+in_flight = registry.register(Gauge("qr_requests_in_flight", "QR requests being handled"))
+errors = registry.register(Counter("qr_errors_total", "QR requests answered with an error", ("format", "status")))
+
+
+def observe_render(format: str, timings: dict):
+    for name, value in timings.items():
+        if name == "version":
+            qr_version.labels(format).observe(value)
+        else:
+            stage_seconds.labels(format, name).observe(value)
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from base import get_bytes, get_svg_qr, get_ascii_qr, get_matrix, flag
+from encoder import Matrix
+from metrics import collect, stage, annotate, registry, CallbackGauge
+from render import compress_variants, COMPRESSIBLE
+
+
+logger = logging.getLogger(__name__)
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+def _render(content_type: str, payload: str, kwargs: dict) -> bytes | str:
+    match content_type:
+        case "image/png":
+            return get_bytes(payload, **kwargs).getvalue()
+        case "text/plain":
+            return get_ascii_qr(payload, **kwargs)
+        case "image/svg+xml":
+            return get_svg_qr(payload, **kwargs)
+    raise ValueError(f"Unsupported content type: {content_type}")
+
+
+def render(content_type: str, payload: str, kwargs: dict,
+           matrix: Matrix | None = None) -> tuple[bytes | str, dict, dict[str, bytes], Matrix | None]:
+    """
+    Rendered body with the stage timings, returned so they reach the metrics of the serving process,
+    its precompressed variants and the matrix when it had to be encoded.
+    """
+    with collect() as timings:
+        encoded = None
+        if matrix is None:
+            matrix = encoded = get_matrix(payload, kwargs.get("version"), kwargs.get("optimize"))
+        else:
+            annotate("version", (matrix.size - 17) // 4)
+        body = _render(content_type, payload, {**kwargs, "matrix": matrix})
+        variants = {}
+        if content_type in COMPRESSIBLE:
+            with stage("compress"):
+                variants = compress_variants(content_type, body)
+        return body, timings, variants, encoded
+
+
+class RenderPool:
+    """
+    Runs renders on a process (default) or thread pool so the event loop never encodes.
+
+    At most ``workers + queue_size`` renders are accepted at once, the rest fail fast
+    with ``RenderQueueFull``. A render that takes longer than ``timeout`` seconds raises
+    ``asyncio.TimeoutError`` for the caller, its slot is released once the worker is done.
+    Streamed renders (``iterate``) take a slot too and run on a thread pool of the same size.
+    When a worker process dies, the renders it broke fail with ``RenderQueueFull`` and a new pool is started.
+
+    Matrices are cached here rather than in the workers, a style change of a payload skips encoding
+    whichever worker it lands on.
+    """
+
+    def __init__(self, kind: str = "process", workers: int | None = None, queue_size: int | None = None,
+                 timeout: float | None = None):
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = self.workers * 4 if queue_size is None else queue_size
+        self.timeout = timeout
+        self.pending = 0
+        self._executor: Executor | None = None
+        self._stream_executor: ThreadPoolExecutor | None = None
+        self.matrix_cache_size = int(os.getenv("ENCODE_CACHE_SIZE", "1024"))
+        self._matrices: OrderedDict[tuple[str, bool], Matrix] = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "RenderPool":
+        timeout = float(os.getenv("RENDER_TIMEOUT", "10"))
+        queue_size = os.getenv("RENDER_QUEUE")
+        return cls(
+            kind=os.getenv("RENDER_EXECUTOR", "process"),
+            workers=int(os.getenv("RENDER_WORKERS", "0")) or None,
+            queue_size=int(queue_size) if queue_size else None,
+            timeout=timeout if timeout > 0 else None,
+        )
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            match self.kind:
+                case "process":
+                    self._executor = ProcessPoolExecutor(self.workers)
+                case "thread":
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="render")
+                case _:
+                    raise ValueError(f"Unknown render executor: {self.kind}")
+        return self._executor
+
+    @property
+    def stream_executor(self) -> ThreadPoolExecutor:
+        if self._stream_executor is None:
+            self._stream_executor = ThreadPoolExecutor(self.workers, thread_name_prefix="render-stream")
+        return self._stream_executor
+
+    def _release(self, future: asyncio.Future):
+        self.pending -= 1
+        if not future.cancelled():
+            # mark the error as retrieved when the caller already gave up on it
+            future.exception()
+
+    def _reserve(self):
+        if self.pending >= self.workers + self.queue_size:
+            raise RenderQueueFull()
+        self.pending += 1
+
+    def _rebuild(self, executor: Executor):
+        # a killed worker breaks the whole process pool, the next submit starts a new one
+        if self._executor is executor:
+            logger.warning("Render pool is broken, starting a new one")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def submit(self, fn, *args):
+        if self.pending >= self.workers + self.queue_size:
+            raise RenderQueueFull()
+        executor = self.executor
+        try:
+            future = asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            self._rebuild(executor)
+            raise RenderQueueFull() from None
+        self.pending += 1
+        future.add_done_callback(self._release)
+        try:
+            # shield keeps the worker result future alive so the slot is freed only on completion
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except BrokenProcessPool:
+            self._rebuild(executor)
+            raise RenderQueueFull() from None
+
+    async def iterate(self, chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Advance a generator off the loop, holding one slot until it's exhausted or closed,
+        and raising ``asyncio.TimeoutError`` once it ran for longer than ``timeout`` seconds in total.
+        """
+        self._reserve()
+        loop = asyncio.get_running_loop()
+        deadline = None if self.timeout is None else loop.time() + self.timeout
+        future = None
+        try:
+            while True:
+                future = loop.run_in_executor(self.stream_executor, next, chunks, None)
+                timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                chunk = await asyncio.wait_for(asyncio.shield(future), timeout)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if future is None or future.done():
+                self.pending -= 1
+            else:
+                # the thread is still in the generator, the slot is freed when it's out
+                future.add_done_callback(self._release)
+
+    async def render(self, content_type: str, payload: str, **kwargs) -> tuple[bytes | str, dict, dict[str, bytes]]:
+        key = (payload, flag(kwargs.get("optimize")))
+        matrix = self._matrices.get(key)
+        if matrix is not None:
+            self._matrices.move_to_end(key)
+        body, timings, variants, encoded = await self.submit(render, content_type, payload, kwargs, matrix)
+        if encoded is not None and self.matrix_cache_size:
+            self._matrices[key] = encoded
+            while len(self._matrices) > self.matrix_cache_size:
+                self._matrices.popitem(last=False)
+        return body, timings, variants
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+        if self._stream_executor is not None:
+            self._stream_executor.shutdown(wait=wait, cancel_futures=True)
+            self._stream_executor = None
+
+
+_pool: RenderPool | None = None
+
+
+def get_pool() -> RenderPool:
+    global _pool
+    if _pool is None:
+        _pool = RenderPool.from_env()
+    return _pool
+
+
+registry.register(CallbackGauge(
+    "qr_render_pending", "Renders submitted to the pool and not finished yet",
+    lambda: {(): _pool.pending if _pool is not None else 0},
+))
@@ -0,0 +1,183 @@
+import gzip
+import io
+import os
+import struct
+import zlib
+import numpy as np
+from encoder import Matrix
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COMPRESSION = int(os.getenv("PNG_COMPRESSION", "-1"))
+PNG_CHUNK_SIZE = 64 * 1024
+MAX_BOX_SIZE = int(os.getenv("PNG_MAX_BOX_SIZE", "100"))
+MAX_BORDER = int(os.getenv("MAX_BORDER", "100"))
+# PNGs with more raw pixel data than this are streamed by the web server and refused by the render cache
+PNG_STREAM_BYTES = int(os.getenv("PNG_STREAM_BYTES", str(4 * 1024 * 1024)))
+
+
+def png_raw_size(version: int, border: int, box_size: int) -> int:
+    side = (version * 4 + 17 + border * 2) * box_size
+    return side * (side // 8 + 2)
+
+# content codings in order of preference, only the available ones
+COMPRESSORS = {
+    **({"br": lambda data: brotli.compress(data, quality=11)} if brotli else {}),
+    **({"zstd": lambda data: zstandard.ZstdCompressor(level=19).compress(data)} if zstandard else {}),
+    "gzip": lambda data: gzip.compress(data, 9, mtime=0),
+}
+# PNG data is deflated already
+COMPRESSIBLE = frozenset({"image/svg+xml", "text/plain"})
+
+_ASCII_CODES = tuple(bytes((code,)).decode("cp437") for code in (255, 223, 220, 219))
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(tag)))
+
+
+def render_png(matrix: Matrix, border: int, color: tuple[int, int, int], background: tuple[int, int, int],
+               box_size: int = 10, level: int = PNG_COMPRESSION) -> bytes:
+    """
+    1-bit palette PNG with ``color`` at index 0 and ``background`` at index 1.
+    """
+    modules = np.frombuffer(matrix.modules, dtype=np.uint8).reshape(matrix.size, matrix.size)
+    light = np.pad(modules == 0, border, constant_values=True)
+    size = light.shape[0] * box_size
+    # pack every module row once, then repeat whole scanlines
+    packed = np.packbits(light.repeat(box_size, axis=1), axis=1)
+    scanlines = np.zeros((light.shape[0], packed.shape[1] + 1), dtype=np.uint8)
+    scanlines[:, 1:] = packed
+    raw = scanlines.repeat(box_size, axis=0).tobytes()
+    return b"".join((
+        PNG_SIGNATURE,
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 1, 3, 0, 0, 0)),
+        _png_chunk(b"PLTE", bytes((*color, *background))),
+        _png_chunk(b"IDAT", zlib.compress(raw, level)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+
+def iter_png(matrix: Matrix, border: int, color: tuple[int, int, int], background: tuple[int, int, int],
+             box_size: int = 10, level: int = PNG_COMPRESSION):
+    """
+    Same image as ``render_png`` produced one scanline at a time through an incremental compressor,
+    yielding pieces of about ``PNG_CHUNK_SIZE`` bytes. Memory does not grow with the image size.
+    """
+    modules = np.frombuffer(matrix.modules, dtype=np.uint8).reshape(matrix.size, matrix.size)
+    dimension = matrix.size + border * 2
+    size = dimension * box_size
+    yield b"".join((
+        PNG_SIGNATURE,
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 1, 3, 0, 0, 0)),
+        _png_chunk(b"PLTE", bytes((*color, *background))),
+    ))
+    compressor = zlib.compressobj(level)
+    pending = []
+    pending_size = 0
+    light = np.ones(dimension, dtype=bool)
+    for r in range(dimension):
+        light[:] = True
+        if border <= r < border + matrix.size:
+            light[border:border + matrix.size] = modules[r - border] == 0
+        scanline = b"\0" + np.packbits(light.repeat(box_size)).tobytes()
+        for _ in range(box_size):
+            data = compressor.compress(scanline)
+            if data:
+                pending.append(data)
+                pending_size += len(data)
+        if pending_size >= PNG_CHUNK_SIZE:
+            yield _png_chunk(b"IDAT", b"".join(pending))
+            pending.clear()
+            pending_size = 0
+    pending.append(compressor.flush())
+    yield _png_chunk(b"IDAT", b"".join(pending)) + _png_chunk(b"IEND", b"")
+
+
+def _dark_runs(matrix: Matrix) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Horizontal runs of dark modules as (row, start column, length) arrays in row-major order.
+    """
+    modules = np.frombuffer(matrix.modules, dtype=np.uint8).reshape(matrix.size, matrix.size)
+    edges = np.diff(np.pad(modules, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends - starts
+
+
+def render_svg(matrix: Matrix, border: int, color: str, background: str, merge_rects: bool = False) -> str:
+    """
+    Single ``<path>`` drawing every horizontal run of dark modules as one ``h`` segment.
+
+    With ``merge_rects`` equal runs of consecutive rows are joined into one rectangle.
+    """
+    dimension = matrix.size + border * 2
+    rows, starts, lengths = _dark_runs(matrix)
+    rows = (rows + border).tolist()
+    starts = (starts + border).tolist()
+    lengths = lengths.tolist()
+    if merge_rects:
+        # (x, width) -> [y, height] of the rectangle still growing downwards
+        open_rects: dict[tuple[int, int], list[int]] = {}
+        rects = []
+        for y, x, w in zip(rows, starts, lengths):
+            rect = open_rects.get((x, w))
+            if rect is not None and rect[0] + rect[1] == y:
+                rect[1] += 1
+            else:
+                if rect is not None:
+                    rects.append((x, rect[0], w, rect[1]))
+                open_rects[(x, w)] = [y, 1]
+        rects.extend((x, y, w, h) for (x, w), (y, h) in open_rects.items())
+        path = [f"M{x} {y}h{w}v{h}h-{w}z" for x, y, w, h in rects]
+    else:
+        path = [f"M{x} {y}h{w}v1h-{w}z" for y, x, w in zip(rows, starts, lengths)]
+    return "".join((
+        f'<svg width="{dimension}mm" height="{dimension}mm" version="1.1" viewBox="0 0 {dimension} {dimension}"'
+        f' xmlns="http://www.w3.org/2000/svg"><rect fill="{background}" x="0" y="0" width="100%" height="100%"/>'
+        f'<path fill="{color}" d="',
+        *path,
+        '"/></svg>',
+    ))
+
+
+def render_ascii(matrix: Matrix, border: int, invert: bool) -> str:
+    size = matrix.size
+    codes = _ASCII_CODES[::-1] if invert else _ASCII_CODES
+
+    def get_module(x, y) -> int:
+        if invert and border and max(x, y) >= size + border:
+            return 1
+        if min(x, y) < 0 or max(x, y) >= size:
+            return 0
+        return matrix.modules[x * size + y]
+
+    s = io.StringIO()
+    for r in range(-border, size + border, 2):
+        for c in range(-border, size + border):
+            s.write(codes[get_module(r, c) + (get_module(r + 1, c) << 1)])
+        s.write("\n")
+    return s.getvalue()
+
+
+def compress_variants(content_type: str, body: bytes | str) -> dict[str, bytes]:
+    """
+    Body compressed once with every available coding, the ones not smaller than the body are left out.
+    """
+    if content_type not in COMPRESSIBLE:
+        return {}
+    data = body.encode() if isinstance(body, str) else body
+    variants = {}
+    for encoding, compress in COMPRESSORS.items():
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            variants[encoding] = compressed
+    return variants
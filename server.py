@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# a child dying sooner than this after its start is restarted with a delay
+MIN_UPTIME = 1.0
+
+
+def get_workers() -> int:
+    return int(os.getenv("WEB_WORKERS", "0")) or os.cpu_count() or 1
+
+
+def run_worker(host: str, port: int):
+    """
+    Serve the app on its own loop, the port is shared with the other workers through SO_REUSEPORT.
+    """
+    from web import make_app
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = web.AppRunner(make_app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port, reuse_port=True)
+    loop.run_until_complete(site.start())
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, loop.stop)
+    logger.info("Worker %s serving on %s:%s", os.getpid(), host, port)
+    try:
+        loop.run_forever()
+    finally:
+        # stops accepting and waits for the running handlers
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+class Supervisor:
+    """
+    Runs every target in a forked child process and restarts the ones that exit until stopped.
+    """
+
+    def __init__(self, targets: list, stop_timeout: float = 30):
+        self.targets = targets
+        self.stop_timeout = stop_timeout
+        self.stopping = False
+        self.children: dict[int, tuple[int, float]] = {}
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.targets[index]()
+            except BaseException:
+                logger.exception("Child %s failed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic())
+
+    def _stop(self, *_):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("Stopping %s children", len(self.children))
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.signal(signal.SIGALRM, self._kill)
+        signal.alarm(int(self.stop_timeout))
+
+    def _kill(self, *_):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(len(self.targets)):
+            self._spawn(index)
+        while self.children:
+            pid, status = os.wait()
+            index, started = self.children.pop(pid, (None, 0))
+            if index is None or self.stopping:
+                continue
+            logger.warning("Child %s exited with status %s, restarting", pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < MIN_UPTIME:
+                time.sleep(MIN_UPTIME)
+            if not self.stopping:
+                self._spawn(index)
+        signal.alarm(0)
+
+
+def serve(workers: int | None = None, host: str = "0.0.0.0", port: int | None = None, extra: tuple = ()):
+    """
+    Pre-fork server: ``workers`` processes each accepting on the same port, plus ``extra`` callables
+    supervised in their own processes.
+    """
+    workers = workers or get_workers()
+    port = port or int(os.getenv("PORT", "8080"))
+    # split the cores between the workers' render pools unless configured
+    os.environ.setdefault("RENDER_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+    targets = [lambda: run_worker(host, port)] * workers + list(extra)
+    Supervisor(targets).run()
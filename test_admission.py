@@ -0,0 +1,115 @@
+import asyncio
+import pytest
+from admission import Admission, Overloaded
+
+
+def test_waiters_are_admitted_in_order():
+    async def run():
+        admission = Admission(limit=2, queue_size=2, deadline=1)
+        await admission.acquire()
+        await admission.acquire()
+        first = asyncio.create_task(admission.acquire())
+        second = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        assert admission.active == 2 and admission.waiting == 2
+        admission.release()
+        await first
+        assert not second.done()
+        admission.release()
+        await asyncio.gather(first, second)
+        # slots were handed over, not freed
+        assert admission.active == 2 and admission.waiting == 0
+        admission.release()
+        admission.release()
+        assert admission.active == 0
+
+    asyncio.run(run())
+
+
+def test_full_queue_is_refused():
+    async def run():
+        admission = Admission(limit=1, queue_size=1, deadline=5)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as e:
+            await admission.acquire()
+        assert e.value.reason == "queue_full" and e.value.retry_after == 5
+        admission.release()
+        await waiter
+        assert admission.active == 1 and admission.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_deadline_is_refused():
+    async def run():
+        admission = Admission(limit=1, queue_size=1, deadline=0.01)
+        await admission.acquire()
+        with pytest.raises(Overloaded) as e:
+            await admission.acquire()
+        assert e.value.reason == "deadline"
+        assert admission.active == 1 and admission.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_slot_handed_over_at_the_deadline_is_released(monkeypatch):
+    admission = Admission(limit=1, queue_size=2, deadline=1)
+    wait_for = asyncio.wait_for
+
+    async def expired(waiter, timeout):
+        # the slot reaches the waiter just as its deadline ends
+        monkeypatch.setattr(asyncio, "wait_for", wait_for)
+        admission.release()
+        raise asyncio.TimeoutError
+
+    async def run():
+        await admission.acquire()
+        monkeypatch.setattr(asyncio, "wait_for", expired)
+        with pytest.raises(Overloaded):
+            await admission.acquire()
+        assert admission.active == 0 and admission.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_slot_handed_over_at_the_deadline_goes_to_the_next_waiter(monkeypatch):
+    admission = Admission(limit=1, queue_size=2, deadline=1)
+    wait_for = asyncio.wait_for
+
+    async def expired(waiter, timeout):
+        monkeypatch.setattr(asyncio, "wait_for", wait_for)
+        await asyncio.sleep(0)
+        admission.release()
+        raise asyncio.TimeoutError
+
+    async def run():
+        await admission.acquire()
+        monkeypatch.setattr(asyncio, "wait_for", expired)
+        late = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        # queued behind the late waiter
+        queued = asyncio.create_task(admission.acquire())
+        with pytest.raises(Overloaded):
+            await late
+        await queued
+        assert admission.active == 1 and admission.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        admission = Admission(limit=1, queue_size=1, deadline=5)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert admission.waiting == 0
+        admission.release()
+        assert admission.active == 0
+
+    asyncio.run(run())
@@ -0,0 +1,101 @@
+import asyncio
+from cache import SingleFlight
+
+
+class Call:
+    """
+    Call held until ``release``, counting how often it was started.
+    """
+
+    def __init__(self, result=None, error: Exception | None = None):
+        self.result = result
+        self.error = error
+        self.started = 0
+        self.event = asyncio.Event()
+
+    async def __call__(self):
+        self.started += 1
+        await self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def release(self):
+        self.event.set()
+
+
+def test_waiters_share_one_call():
+    async def run():
+        flight, call = SingleFlight(), Call("body")
+        waiters = [asyncio.create_task(flight.do(("k",), call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert len(flight) == 1
+        call.release()
+        assert await asyncio.gather(*waiters) == ["body"] * 3
+        assert call.started == 1 and flight.coalesced == 2
+        assert len(flight) == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_cancel_the_call():
+    async def run():
+        flight, call = SingleFlight(), Call("body")
+        first = asyncio.create_task(flight.do(("k",), call))
+        second = asyncio.create_task(flight.do(("k",), call))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        assert first.cancelled() and len(flight) == 1
+        call.release()
+        assert await second == "body"
+        assert call.started == 1 and len(flight) == 0
+
+    asyncio.run(run())
+
+
+def test_call_finishes_when_every_waiter_is_cancelled():
+    async def run():
+        flight, call = SingleFlight(), Call(error=ValueError("bad"))
+        waiter = asyncio.create_task(flight.do(("k",), call))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        call.release()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert len(flight) == 0
+
+    asyncio.run(run())
+
+
+def test_error_reaches_every_waiter_and_clears_the_entry():
+    async def run():
+        flight, call = SingleFlight(), Call(error=ValueError("bad"))
+        waiters = [asyncio.create_task(flight.do(("k",), call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        call.release()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert call.started == 1 and len(flight) == 0
+        # the next call starts over instead of getting the error
+        retry = Call("body")
+        retry.release()
+        assert await flight.do(("k",), retry) == "body"
+        assert retry.started == 1
+
+    asyncio.run(run())
+
+
+def test_keys_do_not_share_calls():
+    async def run():
+        flight, first, second = SingleFlight(), Call("a"), Call("b")
+        waiters = [asyncio.create_task(flight.do(("a",), first)), asyncio.create_task(flight.do(("b",), second))]
+        await asyncio.sleep(0)
+        assert len(flight) == 2
+        first.release()
+        second.release()
+        assert await asyncio.gather(*waiters) == ["a", "b"]
+        assert flight.coalesced == 0
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+import pytest
+import qrcode
+from qrcode.constants import ERROR_CORRECT_L, ERROR_CORRECT_M, ERROR_CORRECT_Q, ERROR_CORRECT_H
+from encoder import encode, fit, DataTooLong
+
+LEVELS = (ERROR_CORRECT_L, ERROR_CORRECT_M, ERROR_CORRECT_Q, ERROR_CORRECT_H)
+ALPHABETS = {"numeric": "0123456789", "alphanumeric": "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:",
+             "byte": "abcdefghijklmnopqrstuvwxyz{}"}
+# version 40 capacity in characters per mode, from ISO/IEC 18004 table 7
+MAX_CHARS = {
+    "numeric": {ERROR_CORRECT_L: 7089, ERROR_CORRECT_M: 5596, ERROR_CORRECT_Q: 3993, ERROR_CORRECT_H: 3057},
+    "alphanumeric": {ERROR_CORRECT_L: 4296, ERROR_CORRECT_M: 3391, ERROR_CORRECT_Q: 2420, ERROR_CORRECT_H: 1852},
+    "byte": {ERROR_CORRECT_L: 2953, ERROR_CORRECT_M: 2331, ERROR_CORRECT_Q: 1663, ERROR_CORRECT_H: 1273},
+}
+
+
+def text(mode: str, length: int) -> str:
+    alphabet = ALPHABETS[mode]
+    return "".join(alphabet[i * 7 % len(alphabet)] for i in range(length))
+
+
+def reference(data: str, error_correction: int) -> bytes:
+    qr = qrcode.QRCode(error_correction=error_correction, border=0)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return bytes(bool(module) for row in qr.modules for module in row)
+
+
+def assert_matches(data: str, error_correction: int):
+    matrix = encode(data, error_correction)
+    assert matrix.modules == reference(data, error_correction)
+
+
+def last_length(mode: str, error_correction: int, version: int) -> int:
+    """
+    Length of the longest ``mode`` text still fitting in ``version``.
+    """
+    low, high = 1, MAX_CHARS[mode][error_correction]
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fit(text(mode, middle), error_correction) <= version:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+@pytest.mark.parametrize("error_correction", LEVELS)
+@pytest.mark.parametrize("data", [
+    "1", "0123456789", "HELLO WORLD", "hello world", "https://example.com/?q=1&r=2",
+    "Привет, мир! ✓", "12345678901234567890123456789abcDEF", "ABC" + "7" * 40 + "xyz" + "QRCODE" * 5,
+])
+def test_modes(data: str, error_correction: int):
+    assert_matches(data, error_correction)
+
+
+@pytest.mark.parametrize("error_correction", LEVELS)
+@pytest.mark.parametrize("mode", ALPHABETS)
+@pytest.mark.parametrize("version", (9, 26))
+def test_version_boundaries(mode: str, error_correction: int, version: int):
+    # 9/10 and 26/27 are where the character count indicators get longer
+    length = last_length(mode, error_correction, version)
+    assert fit(text(mode, length), error_correction) == version
+    assert fit(text(mode, length + 1), error_correction) == version + 1
+    assert_matches(text(mode, length), error_correction)
+    assert_matches(text(mode, length + 1), error_correction)
+
+
+@pytest.mark.parametrize("error_correction", LEVELS)
+@pytest.mark.parametrize("mode", ALPHABETS)
+def test_version_40_limit(mode: str, error_correction: int):
+    length = MAX_CHARS[mode][error_correction]
+    assert fit(text(mode, length), error_correction) == 40
+    with pytest.raises(DataTooLong):
+        fit(text(mode, length + 1), error_correction)
+    with pytest.raises(DataTooLong):
+        encode(text(mode, length + 1), error_correction)
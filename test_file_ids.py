@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+import json
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiogram import Bot, Dispatcher, types
+from file_ids import FileIdCache
+
+
+class FakeBotApi:
+    """
+    Bot API answering sendPhoto like Telegram: uploads get a new file_id, known file_ids are sent as they are.
+    """
+
+    def __init__(self):
+        self.photos: list[str] = []
+        self.rejected: set[str] = set()
+        self._ids = itertools.count(1)
+
+    async def handle(self, req: web.Request) -> web.Response:
+        method = req.match_info["method"]
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 123, "is_bot": True, "first_name": "qr"}})
+        if method != "sendPhoto":
+            return web.json_response({"ok": True, "result": True})
+        data = await req.post()
+        photo = data["photo"] if isinstance(data["photo"], str) else "<upload>"
+        self.photos.append(photo)
+        if photo in self.rejected:
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": "Bad Request: wrong file identifier/HTTP URL specified"},
+                status=400,
+            )
+        file_id = f"FID-{next(self._ids)}" if photo == "<upload>" else photo
+        return web.json_response({"ok": True, "result": {
+            "message_id": next(self._ids), "date": 0, "chat": {"id": 1, "type": "private"},
+            "photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 370, "height": 370}],
+        }})
+
+
+def qr_update(update_id: int, text: str) -> types.Update:
+    return types.Update(**{"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": 1, "type": "private"},
+        "from": {"id": 5, "is_bot": False, "first_name": "u"}, "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+    }})
+
+
+def test_send_photo_reuses_file_ids(monkeypatch, tmp_path):
+    monkeypatch.setenv("RENDER_EXECUTOR", "thread")
+    monkeypatch.setenv("TOKEN", "123:abc")
+    monkeypatch.setenv("BOT_FILE_ID_CACHE", str(tmp_path / "file_ids.json"))
+    from bot import create_dispatcher
+
+    async def run():
+        api = FakeBotApi()
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", api.handle)
+        async with TestServer(app) as server:
+            monkeypatch.setenv("BOT_API_SERVER", str(server.make_url("")).rstrip("/"))
+            dp = create_dispatcher()
+            Bot.set_current(dp.bot)
+            Dispatcher.set_current(dp)
+            try:
+                await dp.process_update(qr_update(1, "/qr hello"))
+                await dp.process_update(qr_update(2, "/qr hello"))
+                api.rejected.add("FID-1")
+                await dp.process_update(qr_update(3, "/qr hello"))
+                await dp.process_update(qr_update(4, "/qr hello"))
+                dp["file_ids"].save()
+            finally:
+                await (await dp.bot.get_session()).close()
+        return api.photos
+
+    photos = asyncio.run(run())
+    # upload, reuse, rejected id and a new upload, reuse of the new id
+    assert photos[:4] == ["<upload>", "FID-1", "FID-1", "<upload>"]
+    assert len(photos) == 5 and photos[4] not in ("<upload>", "FID-1")
+    with open(tmp_path / "file_ids.json") as f:
+        assert [file_id for _, file_id in json.load(f)["entries"]] == [photos[4]]
+
+
+def test_save_merges_workers(tmp_path):
+    path = str(tmp_path / "file_ids.json")
+    first, second = FileIdCache("1", path=path), FileIdCache("1", path=path)
+    first.put(("a",), "A")
+    first.put(("b",), "B")
+    second.put(("c",), "C")
+    first.save()
+    second.save()
+    assert dict(FileIdCache("1", path=path)._entries) == {("a",): "A", ("b",): "B", ("c",): "C"}
+    second.discard(("b",))
+    second.save()
+    assert dict(FileIdCache("1", path=path)._entries) == {("a",): "A", ("c",): "C"}
+    # ids of another bot are ignored
+    assert len(FileIdCache("2", path=path)) == 0
+
+
+def test_put_saves_off_the_loop(tmp_path):
+    path = str(tmp_path / "file_ids.json")
+
+    async def run():
+        cache = FileIdCache("1", path=path, save_every=2)
+        cache.put(("a",), "A")
+        cache.put(("b",), "B")
+        assert cache._saving is not None
+        await cache._saving
+        await asyncio.sleep(0)
+        return cache
+
+    cache = asyncio.run(run())
+    assert cache._saving is None
+    assert dict(FileIdCache("1", path=path)._entries) == {("a",): "A", ("b",): "B"}
@@ -1,24 +1,159 @@
 from aiohttp import web
+from aiohttp.helpers import ETAG_ANY
 import yarl
 import asyncio
+import contextlib
+import hmac
+import signal
+import socket
 import os
+import time
+import zipfile
 from base import *
 from base import _GEN_ARGS
+from pool import get_pool, RenderQueueFull
+from qrcode.constants import ERROR_CORRECT_M
+from encoder import fit, DataTooLong, MAX_LENGTH
+from render import COMPRESSORS, iter_png, png_raw_size, MAX_BOX_SIZE, MAX_BORDER, PNG_STREAM_BYTES, COMPRESSIBLE
+from admission import Overloaded, admission, rate_limiter, client_id, retry_after, shed
+from cache import preferred_encoding, render_encoded, render_key, key_digest, warm_up
+import metrics
+import profiler
+from batch import ZipStream, iter_items, iter_ndjson, render_batch, write_entry
 from aiohttp_swagger3 import SwaggerDocs, SwaggerInfo, SwaggerUiSettings
 
 
-def get_response(payload: str, content_type: str, **kwargs) -> web.Response:
+CACHE_CONTROL = os.getenv("CACHE_CONTROL", "public, max-age=31536000, immutable")
+SERVER_TIMING = os.getenv("SERVER_TIMING", "") not in ("", "0")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def server_timing(timings: dict) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings.items() if name != "version")
+
+
+def accepted_encodings(header: str) -> frozenset:
+    accepted = set()
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        quality = params.strip()
+        try:
+            if quality.startswith("q=") and float(quality[2:]) <= 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip().lower())
+    return frozenset(accepted)
+
+
+async def stream_png(req: web.Request, payload: str, headers: dict, timings: dict | None,
+                     kwargs: dict) -> web.StreamResponse:
+    """
+    Large PNGs skip the render cache: the matrix comes from the pool, the image is compressed
+    scanline by scanline on the pool's stream threads and written as it goes.
+    """
+    start = time.perf_counter()
+    try:
+        matrix = await get_pool().submit(get_matrix, payload, kwargs["version"], kwargs.get("optimize"))
+    except RenderQueueFull:
+        return web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        return web.HTTPGatewayTimeout()
+    if timings is not None:
+        timings["encode"] = time.perf_counter() - start
+        headers["Server-Timing"] = server_timing(timings)
+    color, background = map(hex_to_rgb, get_colors(kwargs.get("color", "#000000"), kwargs.get("background", "#ffffff"),
+                                                   kwargs.get("invert", False)))
+    chunks = iter_png(matrix, int(kwargs.get("border") or 4), color, background,
+                       int(kwargs.get("box_size") or 10))
+    async with contextlib.aclosing(get_pool().iterate(chunks)) as stream:
+        # the first chunk is awaited before the headers, so a full pool or timeout still gets its status
+        try:
+            first = await anext(stream)
+        except RenderQueueFull:
+            return web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+        except asyncio.TimeoutError:
+            return web.HTTPGatewayTimeout()
+        response = web.StreamResponse(headers=headers)
+        response.content_type = "image/png"
+        response.enable_chunked_encoding()
+        await response.prepare(req)
+        await response.write(first)
+        try:
+            async for chunk in stream:
+                await response.write(chunk)
+        except asyncio.TimeoutError:
+            # the status is sent already, a dropped connection tells the client the body is incomplete.
+            # shut down rather than only closed, forked render workers may hold the socket too
+            sock = req.transport.get_extra_info("socket")
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+            req.transport.close()
+            raise
+    await response.write_eof()
+    return response
+
+
+async def get_response(req: web.Request, payload: str, content_type: str, **kwargs) -> web.Response:
     if payload:
-        response = web.Response(charset="utf-8", content_type=content_type,
-                                headers={"Access-Control-Allow-Origin": "*"})
-        match content_type:
-            case "image/png":
-                response.body = get_bytes(payload, **kwargs)
-            case "text/plain":
-                response.body = get_ascii_qr(payload, **kwargs)
-            case "image/svg+xml":
-                response.body = get_svg_qr(payload, **kwargs)
-                # body=f"<pre align='center' style='line-height: 1em;'>{get_ascii_qr(payload)}</pre>",
+        if content_type == "image/png" and kwargs.get("box_size"):
+            try:
+                if not 0 < int(kwargs["box_size"]) <= MAX_BOX_SIZE:
+                    raise ValueError()
+            except ValueError:
+                return web.HTTPBadRequest(text=f"Box size must be from 1 to {MAX_BOX_SIZE}")
+        try:
+            if not 0 <= int(kwargs.get("border") or 0) <= MAX_BORDER:
+                raise ValueError()
+        except ValueError:
+            return web.HTTPBadRequest(text=f"Border must be from 0 to {MAX_BORDER}")
+        # the output is a pure function of the key, so the validator is known before rendering
+        etag = key_digest(render_key(content_type, payload, **kwargs))
+        headers = {"Access-Control-Allow-Origin": "*", "ETag": f'"{etag}"'}
+        if CACHE_CONTROL:
+            headers["Cache-Control"] = CACHE_CONTROL
+        if content_type in COMPRESSIBLE:
+            headers["Vary"] = "Accept-Encoding"
+        timings = None
+        if SERVER_TIMING:
+            # parse is timed from admission, the wait before it is the queue phase
+            admitted = req.get("qr_admitted", req["qr_start"])
+            timings = {"queue": admitted - req["qr_start"], "parse": time.perf_counter() - admitted}
+        req["qr_format"] = metrics.FORMATS[content_type]
+        metrics.payload_bytes.labels(req["qr_format"]).observe(len(payload.encode()))
+        try:
+            # found before any encoding work, the worker reuses it
+            kwargs["version"] = fit(payload, optimize=flag(kwargs.get("optimize")))
+        except DataTooLong as e:
+            return web.HTTPRequestEntityTooLarge(MAX_LENGTH[ERROR_CORRECT_M], len(payload.encode()), text=str(e))
+        accepted = accepted_encodings(req.headers.get("Accept-Encoding", ""))
+        # precompressed variants are tagged "<etag>-<coding>", only the one this request would get matches
+        encoding = preferred_encoding(content_type, accepted, COMPRESSORS)
+        current = {etag, ETAG_ANY} | ({f"{etag}-{encoding}"} if encoding else set())
+        match = next((tag.value for tag in req.if_none_match or () if tag.value in current), None)
+        if match is not None:
+            if match != ETAG_ANY:
+                headers["ETag"] = f'"{match}"'
+            if timings is not None:
+                headers["Server-Timing"] = server_timing(timings)
+            return web.HTTPNotModified(headers=headers)
+        if content_type == "image/png" and png_raw_size(
+                kwargs["version"], int(kwargs.get("border") or 4), int(kwargs.get("box_size") or 10)) > PNG_STREAM_BYTES:
+            return await stream_png(req, payload, headers, timings, kwargs)
+        try:
+            body, encoding = await render_encoded(content_type, payload, accepted, timings, **kwargs)
+        except RenderQueueFull:
+            return web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+        except asyncio.TimeoutError:
+            return web.HTTPGatewayTimeout()
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            headers["ETag"] = f'"{etag}-{encoding}"'
+        if timings is not None:
+            headers["Server-Timing"] = server_timing(timings)
+        response = web.Response(charset="utf-8", content_type=content_type, headers=headers)
+        response.body = body
+        # body=f"<pre align='center' style='line-height: 1em;'>{get_ascii_qr(payload)}</pre>",
         return response
     return web.HTTPBadRequest()
 
@@ -29,8 +164,60 @@ def get_kwargs(query: web.Request.query) -> (dict, dict):
     return kwargs, query
 
 
-def create_app(stop=False):
-    app = web.Application()
+@web.middleware
+async def metrics_middleware(req: web.Request, handler):
+    if not req.path.startswith("/qr"):
+        return await handler(req)
+    start = req["qr_start"] = time.perf_counter()
+    metrics.in_flight.inc()
+    try:
+        response = await handler(req)
+        # written here instead of after the handler returns, so the write is timed too
+        write_start = time.perf_counter()
+        await response.prepare(req)
+        await response.write_eof()
+        write_time = time.perf_counter() - write_start
+    except web.HTTPException as e:
+        metrics.errors.labels(req.get("qr_format", ""), e.status).inc()
+        raise
+    except Exception:
+        metrics.errors.labels(req.get("qr_format", ""), 500).inc()
+        raise
+    finally:
+        metrics.in_flight.dec()
+    format = req.get("qr_format")
+    if format is not None:
+        metrics.stage_seconds.labels(format, "write").observe(write_time)
+        metrics.request_seconds.labels(format).observe(time.perf_counter() - start)
+    if response.status >= 400:
+        metrics.errors.labels(format or "", response.status).inc()
+    return response
+
+
+@web.middleware
+async def admission_middleware(req: web.Request, handler):
+    if not req.path.startswith("/qr"):
+        return await handler(req)
+    try:
+        if rate_limiter is not None:
+            rate_limiter.take(client_id(req.remote, req.headers))
+        await admission.acquire()
+        req["qr_admitted"] = time.perf_counter()
+    except Overloaded as e:
+        shed.labels(e.reason).inc()
+        error = web.HTTPTooManyRequests if e.reason == "rate_limit" else web.HTTPServiceUnavailable
+        return error(headers={"Retry-After": retry_after(e.retry_after)})
+    try:
+        return await handler(req)
+    finally:
+        admission.release()
+
+
+def make_app(webhook: bool = False) -> web.Application:
+    app = web.Application(middlewares=[metrics_middleware, admission_middleware])
+    if webhook:
+        from bot import setup_webhook
+        setup_webhook(app)
     routes = web.RouteTableDef()
 
     @routes.get(r"/qr/png/{payload:.*}")
@@ -91,6 +278,19 @@ def create_app(stop=False):
             description: QR code inversion
             schema:
               type: boolean
+          - name: optimize
+            in: query
+            description: Segment the data into numeric, alphanumeric and byte modes with the fewest bits
+            schema:
+              type: boolean
+          - name: box_size
+            in: query
+            description: Pixels per module of PNG codes, large images are streamed
+            schema:
+              type: integer
+              default: 10
+              minimum: 1
+              maximum: 100
         responses:
           '200':
             description: QR code with given data and params
@@ -101,7 +301,7 @@ def create_app(stop=False):
         """
         kwargs, query = get_kwargs(req.query)
         payload = str(yarl.URL(req.match_info['payload']).update_query(query))
-        return get_response(payload, "image/png", **kwargs)
+        return await get_response(req, payload, "image/png", **kwargs)
 
     @routes.get(r'/qr/png')
     @routes.get(r'/qr/img')
@@ -161,6 +361,19 @@ def create_app(stop=False):
             description: QR code inversion
             schema:
               type: boolean
+          - name: optimize
+            in: query
+            description: Segment the data into numeric, alphanumeric and byte modes with the fewest bits
+            schema:
+              type: boolean
+          - name: box_size
+            in: query
+            description: Pixels per module of PNG codes, large images are streamed
+            schema:
+              type: integer
+              default: 10
+              minimum: 1
+              maximum: 100
         responses:
           '200':
             description: QR code with given data and params
@@ -170,7 +383,7 @@ def create_app(stop=False):
             description: Wrong params
         """
         payload = req.query.get("data", "") or req.query.get("qr", "")
-        return get_response(payload, "image/png", **get_kwargs(req.query)[0])
+        return await get_response(req, payload, "image/png", **get_kwargs(req.query)[0])
 
     @routes.get(r'/qr/ascii/{payload:.*}')
     async def on_ascii(req: web.Request):
@@ -229,6 +442,11 @@ def create_app(stop=False):
             description: QR code inversion
             schema:
               type: boolean
+          - name: optimize
+            in: query
+            description: Segment the data into numeric, alphanumeric and byte modes with the fewest bits
+            schema:
+              type: boolean
         responses:
           '200':
             description: QR code with given data and params
@@ -239,7 +457,7 @@ def create_app(stop=False):
         """
         kwargs, query = get_kwargs(req.query)
         payload = str(yarl.URL(req.match_info['payload']).update_query(query))
-        return get_response(payload, "text/plain", **kwargs)
+        return await get_response(req, payload, "text/plain", **kwargs)
 
     @routes.get(r'/qr/ascii')
     async def on_ascii_query(req: web.Request):
@@ -298,6 +516,11 @@ def create_app(stop=False):
             description: QR code inversion
             schema:
               type: boolean
+          - name: optimize
+            in: query
+            description: Segment the data into numeric, alphanumeric and byte modes with the fewest bits
+            schema:
+              type: boolean
         responses:
           '200':
             description: QR code with given data and params
@@ -307,7 +530,7 @@ def create_app(stop=False):
             description: Wrong params
         """
         payload = req.query.get("data", "") or req.query.get("qr", "")
-        return get_response(payload, "text/plain", **get_kwargs(req.query))
+        return await get_response(req, payload, "text/plain", **get_kwargs(req.query)[0])
 
     @routes.get(r'/qr/svg/{payload:.*}')
     async def on_svg(req: web.Request):
@@ -366,6 +589,11 @@ def create_app(stop=False):
             description: QR code inversion
             schema:
               type: boolean
+          - name: optimize
+            in: query
+            description: Segment the data into numeric, alphanumeric and byte modes with the fewest bits
+            schema:
+              type: boolean
         responses:
           '200':
             description: QR code with given data and params
@@ -376,7 +604,7 @@ def create_app(stop=False):
         """
         kwargs, query = get_kwargs(req.query)
         payload = str(yarl.URL(req.match_info['payload']).update_query(query))
-        return get_response(payload, "image/svg+xml", **kwargs)
+        return await get_response(req, payload, "image/svg+xml", **kwargs)
 
     @routes.get(r'/qr/svg')
     async def on_svg_query(req: web.Request):
@@ -435,6 +663,11 @@ def create_app(stop=False):
             description: QR code inversion
             schema:
               type: boolean
+          - name: optimize
+            in: query
+            description: Segment the data into numeric, alphanumeric and byte modes with the fewest bits
+            schema:
+              type: boolean
         responses:
           '200':
             description: QR code with given data and params
@@ -444,7 +677,7 @@ def create_app(stop=False):
             description: Wrong params
         """
         payload = req.query.get("data", "") or req.query.get("qr", "")
-        return get_response(payload, "image/svg+xml", **get_kwargs(req.query)[0])
+        return await get_response(req, payload, "image/svg+xml", **get_kwargs(req.query)[0])
 
     @routes.get(r'/qr')
     async def on_qr(req: web.Request) -> web.Response:
@@ -512,6 +745,19 @@ def create_app(stop=False):
             description: QR code inversion
             schema:
               type: boolean
+          - name: optimize
+            in: query
+            description: Segment the data into numeric, alphanumeric and byte modes with the fewest bits
+            schema:
+              type: boolean
+          - name: box_size
+            in: query
+            description: Pixels per module of PNG codes, large images are streamed
+            schema:
+              type: integer
+              default: 10
+              minimum: 1
+              maximum: 100
         responses:
           '200':
             description: QR code with given data and params
@@ -531,7 +777,151 @@ def create_app(stop=False):
                 content_type = "image/png"
             case _:
                 return web.HTTPBadRequest()
-        return get_response(payload, content_type, **get_kwargs(req.query)[0])
+        return await get_response(req, payload, content_type, **get_kwargs(req.query)[0])
+
+    @routes.post(r'/qr/batch')
+    async def on_batch(req: web.Request) -> web.StreamResponse:
+        """
+        ---
+        summary: Generate many QR codes at once, streamed back as a ZIP archive
+        description: Entries are named by item index and written as soon as they are rendered,
+          items that failed get an `.error.txt` entry instead. A JSON array is read whole before rendering starts
+          and is limited to 1 MiB, large batches must be sent as NDJSON, one item per line, which is read
+          as it is rendered and has no size limit
+        tags:
+          - qr
+          - batch
+        requestBody:
+          required: true
+          content:
+            application/json:
+              schema:
+                type: array
+                items: &batch_item
+                  type: object
+                  required: [data]
+                  properties:
+                    data:
+                      type: string
+                    type:
+                      type: string
+                      default: png
+                      enum: [svg, img, png, ascii]
+                    color:
+                      type: string
+                      pattern: '^#[0-9a-f]{6}$'
+                    background:
+                      type: string
+                      pattern: '^#[0-9a-f]{6}$'
+                    border:
+                      type: integer
+                      minimum: 1
+                    invert:
+                      type: boolean
+                    optimize:
+                      type: boolean
+                    box_size:
+                      type: integer
+                      minimum: 1
+            application/x-ndjson:
+              schema: *batch_item
+        responses:
+          '200':
+            description: ZIP archive with QR codes
+            content:
+              application/zip: {}
+          '400':
+            description: Wrong body
+          '413':
+            description: JSON array larger than 1 MiB, send it as NDJSON
+        """
+        if req.content_type in ("application/x-ndjson", "application/jsonl"):
+            items = iter_ndjson(req.content)
+        else:
+            try:
+                items = await req.json()
+            except ValueError:
+                return web.HTTPBadRequest()
+            if not isinstance(items, list):
+                return web.HTTPBadRequest()
+            items = iter_items(items)
+        response = web.StreamResponse(headers={
+            "Access-Control-Allow-Origin": "*",
+            "Content-Type": "application/zip",
+            "Content-Disposition": 'attachment; filename="qr.zip"',
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(req)
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, "w") as archive:
+            loop = asyncio.get_running_loop()
+            async for index, content_type, body in render_batch(items):
+                # deflating SVG and text stays off the loop
+                await loop.run_in_executor(None, write_entry, archive, index, content_type, body)
+                await response.write(stream.drain())
+        await response.write(stream.drain())
+        await response.write_eof()
+        return response
+
+    @routes.get("/metrics")
+    async def on_metrics(req: web.Request):
+        """
+        ---
+        summary: Metrics in Prometheus text exposition format
+        tags:
+          - main
+        responses:
+          '200':
+            description: Ok
+        """
+        return web.Response(text=metrics.registry.expose(), content_type="text/plain",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    @routes.get("/admin/profile")
+    async def on_profile(req: web.Request):
+        """
+        ---
+        summary: Sample the stacks of the serving process, as collapsed stacks for flamegraph tools
+        description: Enabled by ADMIN_TOKEN, sent as a bearer token. Renders running in a process pool are not sampled.
+        tags:
+          - admin
+        parameters:
+          - in: query
+            name: seconds
+            schema:
+              type: number
+              default: 10
+              maximum: 60
+          - in: query
+            name: interval
+            schema:
+              type: number
+              default: 0.005
+        responses:
+          '200':
+            description: Collapsed stacks
+          '401':
+            description: Wrong token
+          '409':
+            description: Another profile is running
+        """
+        if not ADMIN_TOKEN:
+            return web.HTTPNotFound()
+        scheme, _, token = req.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return web.HTTPUnauthorized(headers={"WWW-Authenticate": "Bearer"})
+        try:
+            seconds = float(req.query.get("seconds", 10))
+            interval = max(float(req.query.get("interval", 0.005)), 0.001)
+        except ValueError:
+            return web.HTTPBadRequest()
+        try:
+            # sampled from a thread so the loop keeps serving and shows up in the profile
+            stacks = await asyncio.get_running_loop().run_in_executor(None, profiler.sample, seconds, interval)
+        except profiler.ProfilerBusy:
+            return web.HTTPConflict()
+        return web.Response(text=stacks, content_type="text/plain",
+                            headers={"Content-Disposition": 'attachment; filename="profile.folded"'})
 
     @routes.get("/")
     async def on_main(req: web.Request):
@@ -552,10 +942,28 @@ def create_app(stop=False):
         validate=False,
     )
     swagger.add_routes(routes)
-    runner = web.AppRunner(app)
+
+    async def on_cleanup(app: web.Application):
+        get_pool().shutdown(wait=False)
+
+    async def on_startup(app: web.Application):
+        await asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def create_app(stop=False, webhook=False):
+    runner = web.AppRunner(make_app(webhook))
     loop = asyncio.get_event_loop()
     loop.run_until_complete(runner.setup())
     site = web.TCPSite(runner, "0.0.0.0", os.getenv("PORT", "8080"))
     loop.run_until_complete(site.start())
     if stop:
-        loop.run_forever()
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            # runs the cleanup hooks, the webhook saves its file_id cache there
+            loop.run_until_complete(runner.cleanup())